@@ -2,6 +2,9 @@ import pandas as pd
 from pandas.tseries.offsets import DateOffset
 import numpy as np
 import os
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 dispo_map = {"substantiated": 4, "not_substantiated": 3, "truncated": 2, "pending": 1}
 
@@ -286,41 +289,56 @@ def create_outcomes(
     return observation_table_w_outcomes
 
 
-def create_features(observation_table, allegations, lawsuits, past_year_list=[1, 2, 5]):
+def get_features_as_of(
+    observation_date, allegations, lawsuits, past_year_list=[1, 2, 5], verbose=True
+):
 
-    observation_date_list = observation_table["observation_date"].unique()
-    past_year_list = [1, 2, 5]
-    all_observation_list = []
+    """
+        Returns the past_* features of every officer with an allegation or lawsuit in the
+        past_year_list windows before observation_date, indexed by tax_id
+    """
+    feature_df_list = []
+    for y in past_year_list:
+        start_date = pd.to_datetime(observation_date) - DateOffset(years=y)
+        end_date = observation_date
+        if verbose:
+            print(start_date, end_date)
 
-    for observation_date in observation_date_list:
+        temp_allegations = limit_allegations_to_time_period(allegations, start_date, end_date)
+        temp_allegations["dispo_code"] = temp_allegations["ccrb_disposition__collapsed"].map(
+            dispo_map
+        )
+        temp_complaint_summary = summarize_complaints_and_allegations(temp_allegations)
 
-        feature_df_list = []
-        for y in past_year_list:
-            start_date = pd.to_datetime(observation_date) - DateOffset(years=y)
-            end_date = observation_date
-            print(start_date, end_date)
+        temp_lawsuits = limit_lawsuits_to_time_period(lawsuits, start_date, end_date)
+        temp_lawsuit_summary = summarize_lawsuits(temp_lawsuits)
 
-            temp_allegations = limit_allegations_to_time_period(allegations, start_date, end_date)
-            temp_allegations["dispo_code"] = temp_allegations["ccrb_disposition__collapsed"].map(
-                dispo_map
-            )
-            temp_complaint_summary = summarize_complaints_and_allegations(temp_allegations)
+        time_period_name = get_time_period_name(y)
+        temp_complaint_summary = temp_complaint_summary.add_prefix(f"{time_period_name}.")
+        temp_lawsuit_summary = temp_lawsuit_summary.add_prefix(f"{time_period_name}.")
 
-            temp_lawsuits = limit_lawsuits_to_time_period(lawsuits, start_date, end_date)
-            temp_lawsuit_summary = summarize_lawsuits(temp_lawsuits)
+        feature_df_list.append(temp_complaint_summary)
+        feature_df_list.append(temp_lawsuit_summary)
+
+    all_period_features = pd.concat(feature_df_list, axis=1, join="outer")
+    all_period_features["observation_date"] = observation_date
+
+    all_period_features.fillna(0, inplace=True)
+
+    return all_period_features
 
-            time_period_name = get_time_period_name(y)
-            temp_complaint_summary = temp_complaint_summary.add_prefix(f"{time_period_name}.")
-            temp_lawsuit_summary = temp_lawsuit_summary.add_prefix(f"{time_period_name}.")
 
-            feature_df_list.append(temp_complaint_summary)
-            feature_df_list.append(temp_lawsuit_summary)
+def create_features(observation_table, allegations, lawsuits, past_year_list=[1, 2, 5]):
 
-        all_period_features = pd.concat(feature_df_list, axis=1, join="outer")
-        all_period_features["observation_date"] = observation_date
+    observation_date_list = observation_table["observation_date"].unique()
+    past_year_list = [1, 2, 5]
+    all_observation_list = []
 
-        all_period_features.fillna(0, inplace=True)
+    for observation_date in observation_date_list:
 
+        all_period_features = get_features_as_of(
+            observation_date, allegations, lawsuits, past_year_list
+        )
         all_observation_list.append(all_period_features)
 
     all_features = pd.concat(all_observation_list)
@@ -340,6 +358,87 @@ def create_features(observation_table, allegations, lawsuits, past_year_list=[1,
     return observation_table_w_features
 
 
+def apply_dtype_policy(df):
+
+    """
+        Stores the past_*, future_* and phat* columns in the smallest dtype that holds them:
+        counts without missing values become the smallest unsigned integer type, payouts and
+        everything else float32. Other columns (ids, dates) are left alone. Applying it to a
+        frame that already follows the policy changes nothing.
+    """
+    policy_cols = [c for c in df.columns if c.startswith(("past_", "future_", "phat"))]
+    values = df[policy_cols].to_numpy(dtype=np.float64)
+
+    is_count = (
+        ~np.isnan(values).any(axis=0)
+        & (values >= 0).all(axis=0)
+        & (values == np.floor(values)).all(axis=0)
+    )
+    col_max = values.max(axis=0, initial=0)
+
+    dtypes = {}
+    for col, count, max_value in zip(policy_cols, is_count, col_max):
+        if count and not col.endswith("officer_payout") and not col.startswith("phat"):
+            dtypes[col] = np.min_scalar_type(int(max_value))
+        else:
+            dtypes[col] = np.float32
+
+    return df.astype(dtypes)
+
+
+def get_parquet_size(df):
+
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pandas(df), sink)
+    return sink.getvalue().size
+
+
+def report_dtype_policy(name, before, after):
+
+    mb = 1024 ** 2
+    print(
+        f"{name}: {before.memory_usage(deep=True).sum() / mb:.1f} MB in memory and "
+        f"{get_parquet_size(before) / mb:.1f} MB as parquet before the dtype policy, "
+        f"{after.memory_usage(deep=True).sum() / mb:.1f} MB and "
+        f"{get_parquet_size(after) / mb:.1f} MB after"
+    )
+
+
+def write_year_partitioned_parquet(df, path, row_group_size=100000):
+
+    """
+        Writes df as a parquet dataset with one observation_year=<year> directory per year.
+        Rows are sorted by tax_id within each year, so the tax_id statistics of every row group
+        cover a narrow range. Whatever is at path is replaced.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    df = df.assign(observation_year=df["observation_date"].dt.year)
+    df = df.sort_values(["observation_year", "tax_id"])
+    df.to_parquet(
+        path, partition_cols=["observation_year"], index=False, row_group_size=row_group_size
+    )
+
+
+def read_year_partitioned_parquet(path, columns=None, start_year=None, end_year=None):
+
+    """
+        Reads a dataset written by write_year_partitioned_parquet. Only the partitions of the
+        years between start_year and end_year (inclusive) and the given columns are read.
+    """
+    filters = []
+    if start_year is not None:
+        filters.append(("observation_year", ">=", start_year))
+    if end_year is not None:
+        filters.append(("observation_year", "<=", end_year))
+
+    df = pd.read_parquet(path, columns=columns, filters=filters if filters else None)
+    return df.drop(columns=["observation_year"], errors="ignore")
+
+
 if __name__ == "__main__":
 
     main_table = pd.read_parquet(
@@ -357,5 +456,10 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    features.to_parquet(f"{output_dir}/features.parquet")
-    outcomes.to_parquet(f"{output_dir}/outcomes.parquet")
+    compact_features = apply_dtype_policy(features)
+    compact_outcomes = apply_dtype_policy(outcomes)
+    report_dtype_policy("features", features, compact_features)
+    report_dtype_policy("outcomes", outcomes, compact_outcomes)
+
+    write_year_partitioned_parquet(compact_features, f"{output_dir}/features.parquet")
+    write_year_partitioned_parquet(compact_outcomes, f"{output_dir}/outcomes.parquet")
@@ -0,0 +1,95 @@
+import pandas as pd
+import sys
+import argparse
+import tracemalloc
+from time import perf_counter
+from train_models import limit_observations_to_active_officers, assemble_active_officer_table
+
+sys.path.append("../create_features_and_outcomes")
+from create_features_and_outcomes import apply_dtype_policy, read_year_partitioned_parquet
+
+
+def merge_observation_tables(main_table, features, outcomes, career_dates):
+
+    """
+        The earlier assembly path of train_models.py: two hash merges on (tax_id,
+        observation_date), then limit_observations_to_active_officers
+    """
+    features = features.set_index(["tax_id", "observation_date"])
+    outcomes = outcomes.set_index(["tax_id", "observation_date"])
+    main_table = pd.merge(
+        main_table, features, how="left", left_on=["tax_id", "observation_date"], right_index=True
+    )
+    main_table = pd.merge(
+        main_table, outcomes, how="left", left_on=["tax_id", "observation_date"], right_index=True
+    )
+    return limit_observations_to_active_officers(main_table, career_dates)
+
+
+def scale_up(df, scale, tax_id_offset):
+
+    """
+        Stacks scale copies of df, each with its tax_ids shifted to a new range
+    """
+    copies = []
+    for i in range(scale):
+        copy = df.copy()
+        copy["tax_id"] = copy["tax_id"] + i * tax_id_offset
+        copies.append(copy)
+    return pd.concat(copies, ignore_index=True)
+
+
+def measure(func, *args):
+
+    tracemalloc.start()
+    start = perf_counter()
+    result = func(*args)
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--scale", type=int, default=1, help="copies of every officer to benchmark on (default: 1)"
+    )
+    args = parser.parse_args()
+
+    main_table = pd.read_parquet(
+        "../create_observations_main_table/output/observation_table.parquet"
+    )
+    main_table = main_table[main_table.observation_date.between("2014-12-31", "2019-01-02")]
+    features = read_year_partitioned_parquet(
+        "../create_features_and_outcomes/output/features.parquet", start_year=2014, end_year=2019
+    )
+    features = apply_dtype_policy(features)
+    outcomes = read_year_partitioned_parquet(
+        "../create_features_and_outcomes/output/outcomes.parquet", start_year=2014, end_year=2019
+    )
+    outcomes = apply_dtype_policy(outcomes)
+    career_dates = pd.read_parquet("../create_career_start_end_dates/output/career_dates.parquet")
+
+    if args.scale > 1:
+        tax_id_offset = int(main_table["tax_id"].max()) + 1
+        main_table, features, outcomes, career_dates = [
+            scale_up(df, args.scale, tax_id_offset)
+            for df in [main_table, features, outcomes, career_dates]
+        ]
+
+    inputs = (main_table, features, outcomes, career_dates)
+    merged, merge_seconds, merge_peak = measure(merge_observation_tables, *inputs)
+    assembled, assemble_seconds, assemble_peak = measure(assemble_active_officer_table, *inputs)
+    pd.testing.assert_frame_equal(merged, assembled)
+
+    print(f"{len(main_table)} observations, {len(assembled)} active, {features.shape[1]} features")
+    print(
+        f"  merges                        {merge_seconds:8.2f} s "
+        f"{merge_peak / 2 ** 20:10.1f} MB peak"
+    )
+    print(
+        f"  assemble_active_officer_table {assemble_seconds:8.2f} s "
+        f"{assemble_peak / 2 ** 20:10.1f} MB peak"
+    )
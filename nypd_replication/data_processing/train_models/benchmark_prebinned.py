@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import argparse
+import tracemalloc
+from time import perf_counter
+from ml_utils import get_model_search_clf
+
+
+def make_officer_years(n_officers, n_years, n_features, random_state=0):
+
+    """
+        Synthetic officer-year table with count features (10% missing), a rare binary outcome
+        that depends on the first few features, and the tax_id groups of the cv splits
+    """
+    rng = np.random.RandomState(random_state)
+    n_rows = n_officers * n_years
+    features = rng.poisson(rng.uniform(0.1, 5, size=n_features), size=(n_rows, n_features))
+    features = features.astype(np.float32)
+    features[rng.uniform(size=features.shape) < 0.1] = np.nan
+
+    logit = -3.5 + 0.3 * np.nan_to_num(features[:, :5]).sum(axis=1) / 5
+    y = rng.binomial(1, 1 / (1 + np.exp(-logit)))
+    feature_list = [f"feature_{i}" for i in range(n_features)]
+    X = pd.DataFrame(features, columns=feature_list)
+    groups = np.repeat(np.arange(n_officers), n_years)
+    return X, y, groups, feature_list
+
+
+def fit_search(model_type, X, y, groups, feature_list):
+
+    search = get_model_search_clf(model_type, feature_list, [], n_jobs=1)
+    # Fix the early stopping validation split so both searches fit the same models
+    getattr(search, "search", search).estimator.set_params(clf__random_state=0)
+
+    tracemalloc.start()
+    start = perf_counter()
+    search.fit(X, y, groups=groups)
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return search, seconds, peak
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_officers", type=int, default=20000, help="officers (default: 20000)")
+    parser.add_argument("--n_years", type=int, default=6, help="years per officer (default: 6)")
+    parser.add_argument("--n_features", type=int, default=63, help="features (default: 63)")
+    args = parser.parse_args()
+
+    X, y, groups, feature_list = make_officer_years(args.n_officers, args.n_years, args.n_features)
+
+    plain, plain_seconds, plain_peak = fit_search("HistGBM", X, y, groups, feature_list)
+    prebinned, prebinned_seconds, prebinned_peak = fit_search(
+        "HistGBM_prebinned", X, y, groups, feature_list
+    )
+    print("same best parameters", plain.best_params_ == prebinned.best_params_)
+    print(
+        "max abs difference in predictions",
+        np.abs(plain.predict_proba(X)[:, 1] - prebinned.predict_proba(X)[:, 1]).max(),
+    )
+
+    print(f"{len(X)} rows, {X.shape[1]} features, grid search over 9 candidates x 3 folds")
+    print(
+        f"  HistGBM           {plain_seconds:8.2f} s {plain_peak / 2 ** 20:10.1f} MB peak"
+    )
+    print(
+        f"  HistGBM_prebinned {prebinned_seconds:8.2f} s {prebinned_peak / 2 ** 20:10.1f} MB peak"
+    )
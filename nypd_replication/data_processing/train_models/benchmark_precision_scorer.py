@@ -0,0 +1,67 @@
+import numpy as np
+import argparse
+from timeit import timeit
+from ml_utils import get_precision_at_thresholds, get_fast_precision_at_thresholds
+
+
+def get_position_order_precision_at_thresholds(y_true, y_pred, thresholds=[0.01, 0.05, 0.02, 0.1]):
+
+    """
+        Reference for get_fast_precision_at_thresholds: a full stable sort, so tied predictions
+        are taken in order of position
+    """
+    y_flag = np.asarray(y_true) >= 1
+    prediction_order = np.argsort(-np.asarray(y_pred), kind="stable")
+    precision_ranks = [int(thresh * len(y_flag)) for thresh in thresholds]
+    return np.mean([y_flag[prediction_order[:rank]].mean() for rank in precision_ranks])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type=int, default=200000, help="rows per prediction vector")
+    parser.add_argument("--n_vectors", type=int, default=9, help="prediction vectors per batch")
+    parser.add_argument("--repeats", type=int, default=5, help="timing repeats")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    y_true = rng.binomial(1, 0.04, size=args.n_rows)
+    y_preds = rng.uniform(size=(args.n_vectors, args.n_rows)) + 0.5 * y_true
+
+    slow_scores = [get_precision_at_thresholds(y_true, y_pred) for y_pred in y_preds]
+    fast_scores = get_fast_precision_at_thresholds(y_true, y_preds)
+    print(
+        "max abs difference, untied predictions", np.abs(np.array(slow_scores) - fast_scores).max()
+    )
+
+    # predict() labels and rounded probabilities tie at the cutoffs, where the two scorers break
+    # the ties differently. The fast scorer takes them in order of position.
+    for name, tied_preds in [
+        ("0/1 predictions", (y_preds > 1.2) * 1.0),
+        ("rounded predictions", np.round(y_preds, 1)),
+    ]:
+        slow_scores = [get_precision_at_thresholds(y_true, y_pred) for y_pred in tied_preds]
+        fast_scores = get_fast_precision_at_thresholds(y_true, tied_preds)
+        reference_scores = [
+            get_position_order_precision_at_thresholds(y_true, y_pred) for y_pred in tied_preds
+        ]
+        np.testing.assert_allclose(fast_scores, reference_scores, rtol=1e-12)
+        print(f"max abs difference, {name}", np.abs(np.array(slow_scores) - fast_scores).max())
+
+    slow_time = timeit(lambda: get_precision_at_thresholds(y_true, y_preds[0]), number=args.repeats)
+    fast_time = timeit(
+        lambda: get_fast_precision_at_thresholds(y_true, y_preds[0]), number=args.repeats
+    )
+    batch_time = timeit(
+        lambda: get_fast_precision_at_thresholds(y_true, y_preds), number=args.repeats
+    )
+    slow_time, fast_time, batch_time = [
+        1000 * t / args.repeats for t in [slow_time, fast_time, batch_time]
+    ]
+
+    print(f"{args.n_rows} rows, one vector")
+    print(f"  get_precision_at_thresholds      {slow_time:8.2f} ms")
+    print(f"  get_fast_precision_at_thresholds {fast_time:8.2f} ms")
+    print(f"{args.n_rows} rows, batch of {args.n_vectors} vectors")
+    print(f"  get_precision_at_thresholds      {args.n_vectors * slow_time:8.2f} ms")
+    print(f"  get_fast_precision_at_thresholds {batch_time:8.2f} ms")
@@ -0,0 +1,489 @@
+import numpy as np
+import pandas as pd
+import os
+import inspect
+import joblib
+import sklearn
+from joblib import Parallel, delayed
+from time import time
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import GridSearchCV, ParameterGrid
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.metrics import check_scoring, log_loss, roc_auc_score
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+from sklearn.ensemble._hist_gradient_boosting.binning import _BinMapper
+from sklearn.ensemble._hist_gradient_boosting.common import X_BINNED_DTYPE, X_DTYPE
+
+from ml_utils import get_data_fingerprint, get_fast_precision_at_thresholds
+from ml_utils import get_n_iter_used, get_peak_rss_mb
+
+
+class StreamingStandardizer(TransformerMixin, BaseEstimator):
+    """
+        Mean imputation with missing indicators followed by standard scaling, the same steps as
+        the numeric transformer of ml_utils._get_preprocessor with standard_scale=True, but fit
+        one chunk at a time with partial_fit. Means and variances are those of the observed values.
+    """
+
+    def partial_fit(self, X, y=None):
+
+        X = np.asarray(X, dtype=np.float64)
+        if not hasattr(self, "scaler_"):
+            self.scaler_ = StandardScaler()
+            self.n_missing_ = np.zeros(X.shape[1], dtype=np.int64)
+
+        self.scaler_.partial_fit(X)
+        self.n_missing_ += np.isnan(X).sum(axis=0)
+        return self
+
+    def fit(self, X, y=None):
+
+        for attr in ["scaler_", "n_missing_"]:
+            if hasattr(self, attr):
+                delattr(self, attr)
+        return self.partial_fit(X)
+
+    def transform(self, X):
+
+        X = np.asarray(X, dtype=np.float64)
+        missing = np.isnan(X)
+        # After scaling the column mean is 0, so imputing the mean is filling in 0
+        X_scaled = np.nan_to_num(self.scaler_.transform(X), nan=0.0)
+        return np.hstack([X_scaled, missing[:, self.n_missing_ > 0]])
+
+
+class HistBinner(TransformerMixin, BaseEstimator):
+    """
+        Maps every feature to the uint8 bin codes that HistGradientBoostingClassifier would use
+        internally. Fitting it once per outer training split lets every candidate and inner fold
+        of the grid search start from the same binned matrix instead of re-binning the data.
+        Expects imputed data, since the missing-value bin is not carried over to the codes.
+    """
+
+    def __init__(self, max_bins=255, subsample=int(2e5), random_state=None):
+        self.max_bins = max_bins
+        self.subsample = subsample
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+
+        self.bin_mapper_ = _BinMapper(
+            n_bins=self.max_bins + 1, subsample=self.subsample, random_state=self.random_state
+        )
+        self.bin_mapper_.fit(np.asarray(X, dtype=X_DTYPE))
+        return self
+
+    def transform(self, X):
+
+        X = np.asarray(X, dtype=X_DTYPE)
+        if np.isnan(X).any():
+            raise ValueError("HistBinner expects imputed data but X contains missing values")
+        return self.bin_mapper_.transform(X)
+
+
+# PrebinnedHistGradientBoostingClassifier overrides the private _bin_data method of
+# HistGradientBoostingClassifier, which was checked against these scikit-learn versions
+PREBINNED_SKLEARN_VERSIONS = ((1, 0), (1, 3))
+
+
+def _check_bin_data_hook():
+
+    sklearn_version = tuple(int(v) for v in sklearn.__version__.split(".")[:2])
+    if not PREBINNED_SKLEARN_VERSIONS[0] <= sklearn_version <= PREBINNED_SKLEARN_VERSIONS[1]:
+        raise RuntimeError(
+            f"PrebinnedHistGradientBoostingClassifier relies on a private scikit-learn method and "
+            f"was checked against versions {PREBINNED_SKLEARN_VERSIONS}, not {sklearn.__version__}"
+        )
+    bin_data_params = list(inspect.signature(HistGradientBoostingClassifier._bin_data).parameters)
+    if bin_data_params != ["self", "X", "is_training_data"]:
+        raise RuntimeError(
+            f"HistGradientBoostingClassifier._bin_data has changed to {bin_data_params}, "
+            f"PrebinnedHistGradientBoostingClassifier needs to be updated"
+        )
+
+
+class PrebinnedHistGradientBoostingClassifier(HistGradientBoostingClassifier):
+    """
+        HistGradientBoostingClassifier that trains on the codes produced by HistBinner.
+        The codes are used as the bins directly and the split thresholds are placed halfway
+        between consecutive codes, so the fitted model also predicts on binned data.
+        fit raises if the scikit-learn version is outside PREBINNED_SKLEARN_VERSIONS or if the
+        training data did not go through _bin_data.
+    """
+
+    def fit(self, X, y, sample_weight=None):
+
+        _check_bin_data_hook()
+        self._used_prebinned_codes = False
+        super().fit(X, y, sample_weight=sample_weight)
+        if not self._used_prebinned_codes:
+            raise RuntimeError(
+                "HistGradientBoostingClassifier.fit no longer calls _bin_data on the training "
+                "data, PrebinnedHistGradientBoostingClassifier needs to be updated"
+            )
+        return self
+
+    def _bin_data(self, X, is_training_data):
+
+        X_binned = np.asarray(X, dtype=X_BINNED_DTYPE)
+        if not is_training_data:
+            return np.ascontiguousarray(X_binned)
+
+        n_bins_non_missing = X_binned.max(axis=0, initial=0).astype(np.uint32) + 1
+        if (n_bins_non_missing >= self._bin_mapper.n_bins).any():
+            raise ValueError("max_bins is smaller than the number of bins used by HistBinner")
+
+        self._bin_mapper.missing_values_bin_idx_ = self._bin_mapper.n_bins - 1
+        self._bin_mapper.n_bins_non_missing_ = n_bins_non_missing
+        self._bin_mapper.bin_thresholds_ = [
+            np.arange(n - 1, dtype=X_DTYPE) + 0.5 for n in n_bins_non_missing
+        ]
+        self._bin_mapper.is_categorical_ = np.zeros(X_binned.shape[1], dtype=np.uint8)
+        self._used_prebinned_codes = True
+        return np.asfortranarray(X_binned)
+
+
+class PrebinnedSearchCV(BaseEstimator):
+    """
+        Runs the preprocessor and HistBinner once on the training data, then runs the hyperparameter
+        search on the binned matrix. best_estimator_ chains the fitted binning steps with the
+        best classifier so it can be used on raw frames like any other search result.
+    """
+
+    def __init__(self, preprocessor, search, max_bins=255):
+        self.preprocessor = preprocessor
+        self.search = search
+        self.max_bins = max_bins
+
+    def fit(self, X, y, groups=None):
+
+        preprocessor = self.preprocessor
+        if preprocessor != "passthrough":
+            preprocessor = clone(preprocessor)
+
+        self.binning_ = Pipeline(
+            [("preproc", preprocessor), ("binner", HistBinner(max_bins=self.max_bins))]
+        )
+        X_binned = self.binning_.fit_transform(X)
+
+        self.search_ = clone(self.search)
+        self.search_.fit(X_binned, y, groups=groups)
+
+        self.cv_results_ = self.search_.cv_results_
+        self.best_params_ = self.search_.best_params_
+        self.best_score_ = self.search_.best_score_
+        self.best_estimator_ = Pipeline(self.binning_.steps + self.search_.best_estimator_.steps)
+        self.classes_ = self.best_estimator_.classes_
+        return self
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+
+def _narrow_param_grid(param_grid, previous_best_params):
+    """
+        Keeps only the previous best value of each parameter and its neighbours in the grid
+    """
+    narrowed_grid = {}
+    for param, values in param_grid.items():
+        values = list(values)
+        if param in previous_best_params and previous_best_params[param] in values:
+            best_ix = values.index(previous_best_params[param])
+            values = values[max(best_ix - 1, 0) : best_ix + 2]
+        narrowed_grid[param] = values
+    return narrowed_grid
+
+
+def _get_config_repr(value):
+    """
+        repr of value with functions replaced by their qualified names, so that (unlike the repr
+        of a function, which holds its address) it is the same in every run. Estimators are
+        replaced by their class names, since get_params(deep=True) lists their parameters
+        separately.
+    """
+    if isinstance(value, dict):
+        items = sorted(value.items())
+        return "{" + ", ".join(f"{k!r}: {_get_config_repr(v)}" for k, v in items) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(_get_config_repr(v) for v in value) + "]"
+    if hasattr(value, "get_params") and not isinstance(value, type):
+        return type(value).__qualname__
+    if inspect.isroutine(value):
+        return f"{value.__module__}.{value.__qualname__}"
+    return repr(value)
+
+
+class CachedGridSearchCV(GridSearchCV):
+    """
+        GridSearchCV that stores its search results in cache_dir, keyed by a fingerprint of the
+        training data (limited to cache_features when X is a frame), the groups, cache_tag, the
+        parameter grid, the scoring, cv and refit settings and the parameters of the estimator. When
+        the same search is run again the stored results are reused and only the refit of the best
+        parameters is done.
+
+        With narrow_search=True, a search that misses the cache only evaluates the neighbourhood of
+        the best parameters found by the last search with the same settings, whatever its data.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        param_grid,
+        *,
+        cache_dir="search_cache",
+        cache_features=None,
+        cache_tag="",
+        narrow_search=False,
+        scoring=None,
+        n_jobs=None,
+        refit=True,
+        cv=None,
+        verbose=0,
+        pre_dispatch="2*n_jobs",
+        error_score=np.nan,
+        return_train_score=False,
+    ):
+        super().__init__(
+            estimator,
+            param_grid,
+            scoring=scoring,
+            n_jobs=n_jobs,
+            refit=refit,
+            cv=cv,
+            verbose=verbose,
+            pre_dispatch=pre_dispatch,
+            error_score=error_score,
+            return_train_score=return_train_score,
+        )
+        self.cache_dir = cache_dir
+        self.cache_features = cache_features
+        self.cache_tag = cache_tag
+        self.narrow_search = narrow_search
+
+    def _run_search(self, evaluate_candidates):
+        evaluate_candidates(ParameterGrid(self.searched_grid_))
+
+    def fit(self, X, y=None, groups=None, **fit_params):
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        config_key = get_data_fingerprint(
+            np.array(
+                [
+                    self.cache_tag,
+                    repr(self.cache_features),
+                    repr(self.param_grid),
+                    _get_config_repr(self.scoring),
+                    _get_config_repr(self.cv),
+                    _get_config_repr(self.refit),
+                    _get_config_repr(self.estimator.get_params(deep=True)),
+                ]
+            )
+        )
+        X_fingerprint = X
+        if self.cache_features is not None and isinstance(X, pd.DataFrame):
+            X_fingerprint = X[self.cache_features]
+        search_key = get_data_fingerprint(
+            np.array([config_key]), X_fingerprint, y, np.zeros(0) if groups is None else groups
+        )
+
+        search_path = f"{self.cache_dir}/{search_key}.joblib"
+        latest_best_path = f"{self.cache_dir}/{config_key}__latest_best_params.joblib"
+
+        if os.path.exists(search_path):
+            print("reusing cached search results")
+            cached_search = joblib.load(search_path)
+            self.searched_grid_ = cached_search["searched_grid"]
+            self.cv_results_ = cached_search["cv_results"]
+            self.best_index_ = cached_search["best_index"]
+            self.best_params_ = cached_search["best_params"]
+            self.best_score_ = cached_search["best_score"]
+            self.n_splits_ = cached_search["n_splits"]
+            self.multimetric_ = isinstance(self.scoring, dict)
+            if self.multimetric_:
+                self.scorer_ = {
+                    name: check_scoring(self.estimator, scoring=scoring)
+                    for name, scoring in self.scoring.items()
+                }
+            else:
+                self.scorer_ = check_scoring(self.estimator, scoring=self.scoring)
+
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+            self.best_estimator_.fit(X, y, **fit_params)
+            return self
+
+        self.searched_grid_ = self.param_grid
+        if self.narrow_search and os.path.exists(latest_best_path):
+            self.searched_grid_ = _narrow_param_grid(self.param_grid, joblib.load(latest_best_path))
+            print("narrowed search to", self.searched_grid_)
+
+        super().fit(X, y, groups=groups, **fit_params)
+
+        cached_search = {
+            "searched_grid": self.searched_grid_,
+            "cv_results": self.cv_results_,
+            "best_index": self.best_index_,
+            "best_params": self.best_params_,
+            "best_score": self.best_score_,
+            "n_splits": self.n_splits_,
+        }
+        joblib.dump(cached_search, search_path)
+        joblib.dump(self.best_params_, latest_best_path)
+        return self
+
+
+def _fit_and_score_staged(estimator, params, X, y, train_ix, test_ix, n_iter_grid, score_func):
+    """
+        Fits estimator once with params on the training split and scores its staged predictions
+        on the test split at every iteration count in n_iter_grid. Counts past the number of
+        iterations that were actually fit reuse the score of the last one.
+        Returns the scores, the fit and score times, the iterations fit and the peak RSS of the
+        worker.
+    """
+    estimator = clone(estimator).set_params(**params)
+
+    start_time = time()
+    estimator.fit(_safe_rows(X, train_ix), y[train_ix])
+    fit_time = time() - start_time
+
+    start_time = time()
+    X_test = estimator[:-1].transform(_safe_rows(X, test_ix))
+    staged_probas = []
+    for n_iter, proba in enumerate(estimator[-1].staged_predict_proba(X_test), start=1):
+        if n_iter in n_iter_grid:
+            staged_probas.append(proba[:, 1])
+    staged_probas += staged_probas[-1:] * (len(n_iter_grid) - len(staged_probas))
+
+    scores = [score_func(y[test_ix], proba) for proba in staged_probas]
+    score_time = time() - start_time
+    return scores, fit_time, score_time, get_n_iter_used(estimator), get_peak_rss_mb()
+
+
+def _safe_rows(X, ix):
+    return X.iloc[ix] if hasattr(X, "iloc") else X[ix]
+
+
+def _get_staged_score_func(scoring):
+
+    staged_score_funcs = {
+        "neg_log_loss": lambda y, proba: -log_loss(y, proba, labels=[0, 1]),
+        "roc_auc": roc_auc_score,
+        "precision_at_thresholds": get_fast_precision_at_thresholds,
+    }
+    if scoring not in staged_score_funcs:
+        raise ValueError(
+            f"StagedGridSearchCV does not support scoring {scoring!r}, "
+            f"expected one of {list(staged_score_funcs)}"
+        )
+    return staged_score_funcs[scoring]
+
+
+class StagedGridSearchCV(BaseEstimator):
+    """
+        Grid search where the number of boosting iterations is a search dimension that costs no
+        extra fits. Every candidate of param_grid is fit once per split with n_iter_param set to
+        max(n_iter_grid), and its staged predictions on the test split are scored at every count
+        in n_iter_grid. The best (candidate, count) pair is refit on all the data.
+
+        The estimator is a Pipeline whose last step supports staged_predict_proba, and early
+        stopping should be turned off so every stage is fit.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        param_grid,
+        n_iter_grid,
+        n_iter_param="clf__max_iter",
+        scoring="neg_log_loss",
+        cv=None,
+        n_jobs=None,
+    ):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.n_iter_grid = n_iter_grid
+        self.n_iter_param = n_iter_param
+        self.scoring = scoring
+        self.cv = cv
+        self.n_jobs = n_jobs
+
+    def fit(self, X, y, groups=None):
+
+        y = np.asarray(y)
+        score_func = _get_staged_score_func(self.scoring)
+        n_iter_grid = sorted(self.n_iter_grid)
+        candidates = [
+            {**params, self.n_iter_param: n_iter_grid[-1]}
+            for params in ParameterGrid(self.param_grid)
+        ]
+        splits = list(self.cv.split(X, y, groups))
+
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_fit_and_score_staged)(
+                self.estimator,
+                params,
+                X,
+                y,
+                train_ix,
+                test_ix,
+                n_iter_grid,
+                score_func,
+            )
+            for params in candidates
+            for train_ix, test_ix in splits
+        )
+
+        # (candidate, split, n_iter) -> (candidate * n_iter, split), like GridSearchCV's cv_results_
+        scores = np.array([r[0] for r in results]).reshape(len(candidates), len(splits), -1)
+        scores = scores.transpose(0, 2, 1).reshape(-1, len(splits))
+        fit_times, score_times, n_iters_fit, peak_rss = [
+            np.array([r[k] for r in results]).reshape(len(candidates), len(splits))
+            for k in [1, 2, 3, 4]
+        ]
+
+        all_params = [
+            {**params, self.n_iter_param: n_iter}
+            for params in candidates
+            for n_iter in n_iter_grid
+        ]
+        mean_scores = scores.mean(axis=1)
+        self.cv_results_ = {
+            "params": all_params,
+            "mean_test_score": mean_scores,
+            "std_test_score": scores.std(axis=1),
+            "rank_test_score": pd.Series(-mean_scores).rank(method="min").values.astype(int),
+            "mean_fit_time": np.repeat(fit_times.mean(axis=1), len(n_iter_grid)),
+            "mean_score_time": np.repeat(score_times.mean(axis=1), len(n_iter_grid)),
+            # The iterations fit, not the counts scored, to compare with the other searches
+            "mean_test_n_iter": np.repeat(n_iters_fit.mean(axis=1), len(n_iter_grid)),
+        }
+        for split_ix in range(len(splits)):
+            self.cv_results_[f"split{split_ix}_test_score"] = scores[:, split_ix]
+            self.cv_results_[f"split{split_ix}_test_peak_rss_mb"] = np.repeat(
+                peak_rss[:, split_ix], len(n_iter_grid)
+            )
+        for param in all_params[0]:
+            self.cv_results_[f"param_{param}"] = np.array(
+                [p[param] for p in all_params], dtype=object
+            )
+
+        self.best_index_ = int(np.argmax(self.cv_results_["mean_test_score"]))
+        self.best_params_ = all_params[self.best_index_]
+        self.best_score_ = self.cv_results_["mean_test_score"][self.best_index_]
+        self.n_splits_ = len(splits)
+
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        self.best_estimator_.fit(X, y)
+        self.classes_ = self.best_estimator_.classes_
+        return self
+
+    def predict_proba(self, X):
+        return self.best_estimator_.predict_proba(X)
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
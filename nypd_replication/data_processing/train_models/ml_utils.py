@@ -1,18 +1,46 @@
 import numpy as np
-from sklearn.pipeline import Pipeline
-from sklearn.compose import ColumnTransformer
-from sklearn.impute import SimpleImputer
-from sklearn.preprocessing import OneHotEncoder, StandardScaler
-from sklearn.ensemble import GradientBoostingClassifier
-from sklearn.model_selection import train_test_split, RandomizedSearchCV, GridSearchCV
-from sklearn.model_selection import StratifiedGroupKFold, GroupKFold
-from sklearn.ensemble import HistGradientBoostingClassifier, RandomForestClassifier
-from sklearn.linear_model import LogisticRegression, ElasticNet
-from sklearn.metrics import make_scorer
+import pandas as pd
+import sys
+import hashlib
+import importlib
+import warnings
+from functools import partial
+
+# sklearn and the estimator classes are only imported once a model is built, so tools that only
+# need the helpers below, or that load saved models, start quickly. The classes used to be
+# defined here and are still reachable as ml_utils.<name>, which older saved models refer to.
+_ESTIMATOR_CLASSES = [
+    "StreamingStandardizer",
+    "HistBinner",
+    "PrebinnedHistGradientBoostingClassifier",
+    "PrebinnedSearchCV",
+    "CachedGridSearchCV",
+    "StagedGridSearchCV",
+]
+
+
+def __getattr__(name):
+
+    if name in _ESTIMATOR_CLASSES:
+        return getattr(importlib.import_module("estimators"), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _import(path):
+    """
+        Imports the object at a dotted path such as "sklearn.ensemble.GradientBoostingClassifier"
+    """
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
 
 
 def _get_preprocessor(numeric_model_features, categorical_model_features, standard_scale=False):
 
+    from sklearn.pipeline import Pipeline
+    from sklearn.compose import ColumnTransformer
+    from sklearn.impute import SimpleImputer
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
     if standard_scale == True:
         numeric_transformer = Pipeline(
             steps=[("imputer", SimpleImputer(add_indicator=True)), ("scale", StandardScaler())]
@@ -40,184 +68,406 @@ def _get_preprocessor(numeric_model_features, categorical_model_features, standa
     return preprocessor
 
 
-def get_model_search_clf(
-    model_type,
-    numeric_model_features,
-    categorical_model_features,
-    n_groups=3,
-    scoring_func="neg_log_loss",
-    n_jobs=1,
-):
+def get_data_fingerprint(*arrays):
+    """
+        Returns a sha256 hex digest of the values (and column names) of every frame, series or array
+    """
+    fingerprint = hashlib.sha256()
+    for a in arrays:
+        if isinstance(a, pd.DataFrame):
+            fingerprint.update(",".join(map(str, a.columns)).encode())
+        if isinstance(a, (pd.DataFrame, pd.Series)):
+            fingerprint.update(pd.util.hash_pandas_object(a, index=False).values.tobytes())
+        else:
+            a = np.ascontiguousarray(a)
+            fingerprint.update(f"{a.dtype}{a.shape}".encode())
+            fingerprint.update(a.tobytes())
+    return fingerprint.hexdigest()
+
+
+DEFAULT_MODEL_TYPE = "HistGBM"
+
+_BOOSTING_GRID = {"clf__max_depth": [1, 3, 5], "clf__learning_rate": [0.5, 0.1, 0.01]}
+
+# Every model type that get_model_search_clf can build. "estimator" is the dotted path of the
+# classifier, which is only imported when the model type is used, and "estimator_params" are its
+# arguments, or a function of (numeric_model_features, n_jobs) that returns them. "param_grid" is
+# searched over by the "search" strategy with the "scoring" metric. Missing keys are taken from
+# _SPEC_DEFAULTS.
+_SPEC_DEFAULTS = {
+    "estimator": "sklearn.ensemble.HistGradientBoostingClassifier",
+    "estimator_params": {},
+    "param_grid": _BOOSTING_GRID,
+    "scoring": "neg_log_loss",
+    "standard_scale": False,
+    "search": "grid",
+}
+
+MODEL_SPECS = {
+    "GBM": {
+        "estimator": "sklearn.ensemble.GradientBoostingClassifier",
+        "estimator_params": {"n_estimators": 1000, "n_iter_no_change": 25},
+        "param_grid": {"clf__max_depth": [1, 2, 3], "clf__learning_rate": [0.1, 0.01]},
+    },
+    "HistGBM__test": {"estimator_params": {"max_iter": 5}},
+    "HistGBM": {"estimator_params": {"max_iter": 500}},
+    "HistGBM_prebinned": {
+        "estimator": "estimators.PrebinnedHistGradientBoostingClassifier",
+        "estimator_params": {"max_iter": 500},
+        "search": "prebinned",
+    },
+    "HistGBM_staged": {
+        "estimator_params": {"max_iter": 500, "early_stopping": False},
+        "search": "staged",
+        "n_iter_grid": list(np.arange(10, 501, 10)),
+        "n_iter_param": "clf__max_iter",
+    },
+    "GBM_staged": {
+        "estimator": "sklearn.ensemble.GradientBoostingClassifier",
+        "estimator_params": {"n_estimators": 1000},
+        "param_grid": {"clf__max_depth": [1, 2, 3], "clf__learning_rate": [0.1, 0.01]},
+        "search": "staged",
+        "n_iter_grid": list(np.arange(25, 1001, 25)),
+        "n_iter_param": "clf__n_estimators",
+    },
+    # Enforcing that all features have a positive relationship with outcome because why not
+    "HistGBMmonotone": {
+        "estimator_params": lambda numeric_model_features, n_jobs: {
+            "max_iter": 500,
+            "monotonic_cst": [1 for _ in numeric_model_features],
+        },
+    },
+    "RandomForest": {
+        "estimator": "sklearn.ensemble.RandomForestClassifier",
+        "estimator_params": lambda numeric_model_features, n_jobs: {
+            "n_estimators": 100,
+            "n_jobs": n_jobs,
+        },
+        "param_grid": {"clf__max_features": [0.1, 0.5], "clf__max_depth": [3, 5, None]},
+    },
+    "HistGBM_randomCV": {
+        "estimator_params": {"max_iter": 500},
+        "param_grid": lambda: {
+            "clf__max_depth": [None, 2, 3, 4],
+            "clf__learning_rate": _import("scipy.stats.lognorm")(
+                s=0.5, scale=np.exp(-4), loc=np.exp(-7)
+            ),
+            "clf__max_leaf_nodes": _import("scipy.stats.randint")(5, 31),
+            "clf__min_samples_leaf": _import("scipy.stats.randint")(2, 20),
+        },
+        "search": "random",
+    },
+    "HistGBM_precision_opt": {
+        "estimator_params": lambda numeric_model_features, n_jobs: {
+            "max_iter": 500,
+            "scoring": _get_scorer("precision_at_thresholds"),
+        },
+        "scoring": "precision_at_thresholds",
+    },
+    "logistic": {
+        "estimator": "sklearn.linear_model.LogisticRegression",
+        "estimator_params": {"penalty": "elasticnet", "solver": "saga", "max_iter": 500},
+        "param_grid": {
+            "clf__l1_ratio": [0.1, 0.5, 0.9],
+            "clf__C": [0.0001, 0.001, 0.01, 0.1, 1, 10, 100],
+        },
+        "standard_scale": True,
+    },
+    "nonnegative_LPM": {
+        "estimator": "sklearn.linear_model.ElasticNet",
+        "estimator_params": {"positive": True},
+        "param_grid": {
+            "clf__l1_ratio": [0.1, 0.5, 0.9],
+            "clf__alpha": [0.01, 1, 10, 500, 1000, 10000],
+        },
+        "scoring": "roc_auc",
+        "standard_scale": True,
+    },
+    "dummy": {
+        "estimator": "sklearn.dummy.DummyClassifier",
+        "param_grid": {"clf__strategy": ["prior", "uniform"]},
+    },
+}
+
+
+def get_n_iter_used(estimator, X=None, y=None):
+    """
+        Scorer that reports the boosting iterations (or solver iterations) the last step of a
+        fitted pipeline actually used, 0 for models that are not fit iteratively
+    """
+    clf = estimator[-1] if hasattr(estimator, "steps") else estimator
+    for attr in ["n_iter_", "n_estimators_"]:
+        if hasattr(clf, attr):
+            return float(np.max(getattr(clf, attr)))
+    return 0.0
+
 
+def get_peak_rss_mb(estimator=None, X=None, y=None):
     """
-    Returns: 
-        - GridSearch or RandomSearch estimator that implements fit() and get_best_estimator_. Also has GroupKFold cv strategy
+        Scorer that reports the peak resident memory, in MB, of the process it runs in. Run right
+        after a fit in a search worker, this is the worker's peak up to the end of that fit.
     """
+    import resource
 
-    scoring_func = "neg_log_loss"
-    if model_type == "GBM":
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
 
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
-        pipe = Pipeline(
-            [
-                ("preproc", preprocessor),
-                ("clf", GradientBoostingClassifier(n_estimators=1000, n_iter_no_change=25)),
-            ]
-        )
-        params = {"clf__max_depth": [1, 2, 3], "clf__learning_rate": [0.1, 0.01]}
 
-    if model_type == "HistGBM__test":
+# Extra metrics recorded for every candidate and split of a search next to its score. They end up
+# in cv_results_ as mean_test_n_iter and split<k>_test_peak_rss_mb; see get_search_telemetry.
+TELEMETRY_SCORERS = {"n_iter": get_n_iter_used, "peak_rss_mb": get_peak_rss_mb}
 
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
-        pipe = Pipeline(
-            [("preproc", preprocessor), ("clf", HistGradientBoostingClassifier(max_iter=5))]
-        )
-        params = {"clf__max_depth": [1, 3, 5], "clf__learning_rate": [0.5, 0.1, 0.01]}
 
-    if model_type == "HistGBM":
+def get_search_telemetry(search):
+    """
+        Returns one row per candidate of a fitted search with its parameters, the mean fit and
+        score time over the inner splits, the boosting iterations it used, the peak RSS of the
+        workers that fit it and its score. Values missing from cv_results_, e.g. in search
+        results cached before they were recorded, are NaN.
+        fit_params leaves out the iteration count of a StagedGridSearchCV, since all the counts
+        of a candidate are scored on the same fit.
+    """
+    search = getattr(search, "search_", search)
+    cv_results = search.cv_results_
+    n_candidates = len(cv_results["params"])
+    n_iter_param = getattr(search, "n_iter_param", None)
+
+    def get_column(key):
+        return np.asarray(cv_results.get(key, np.full(n_candidates, np.nan)), dtype=np.float64)
+
+    rss_keys = [k for k in cv_results if k.startswith("split") and k.endswith("_test_peak_rss_mb")]
+    return pd.DataFrame(
+        {
+            "params": [repr(params) for params in cv_results["params"]],
+            "fit_params": [
+                repr({k: v for k, v in params.items() if k != n_iter_param})
+                for params in cv_results["params"]
+            ],
+            "mean_fit_time": get_column("mean_fit_time"),
+            "mean_score_time": get_column("mean_score_time"),
+            "n_iter": get_column("mean_test_n_iter"),
+            "peak_rss_mb": np.max([cv_results[k] for k in rss_keys], axis=0)
+            if len(rss_keys) > 0
+            else np.nan,
+            "mean_test_score": get_column("mean_test_score"),
+            "is_best": np.arange(n_candidates) == search.best_index_,
+        }
+    )
+
+
+def get_model_spec(model_type):
+
+    if model_type not in MODEL_SPECS:
+        raise ValueError(f"unknown model_type {model_type!r}, expected one of {list(MODEL_SPECS)}")
+    return {**_SPEC_DEFAULTS, **MODEL_SPECS[model_type]}
 
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
+
+def get_warm_start_iter_param(model_type):
+    """
+        Returns the parameter with the number of boosting iterations of the classifier of
+        model_type ("max_iter" or "n_estimators"), which is raised to continue a fitted model
+        with warm_start. Raises for classifiers that are not boosted or have no warm_start, and
+        for HistGradientBoostingClassifier, which refits its bins on every fit, so the earlier
+        trees would be evaluated on different bin codes. PrebinnedHistGradientBoostingClassifier
+        keeps the HistBinner codes and can be continued.
+    """
+    from sklearn.ensemble import HistGradientBoostingClassifier
+    from estimators import PrebinnedHistGradientBoostingClassifier
+
+    clf = get_model_spec(model_type)["estimator"]
+    clf_class = _import(clf)
+    clf_params = clf_class().get_params()
+    iter_params = [p for p in ["max_iter", "n_estimators"] if p in clf_params]
+    if not hasattr(clf_class, "staged_predict_proba") or "warm_start" not in clf_params:
+        raise ValueError(
+            f"model_type {model_type!r} ({clf}) cannot add boosting iterations with warm_start"
         )
-        pipe = Pipeline(
-            [("preproc", preprocessor), ("clf", HistGradientBoostingClassifier(max_iter=500))]
+    if issubclass(clf_class, HistGradientBoostingClassifier) and not issubclass(
+        clf_class, PrebinnedHistGradientBoostingClassifier
+    ):
+        raise ValueError(
+            f"model_type {model_type!r} ({clf}) rebins the data on every warm_start fit, "
+            f"use HistGBM_prebinned instead"
         )
-        params = {"clf__max_depth": [1, 3, 5], "clf__learning_rate": [0.5, 0.1, 0.01]}
+    return iter_params[0]
 
-    if model_type == "HistGBMmonotone":
 
-        """
-            Enforcing that all features have a positive relationship with outcome because why not
-        """
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
+def _get_scorer(scoring):
 
-        montone_constraints = [1 for i in np.arange(len(numeric_model_features))]
-        pipe = Pipeline(
-            [
-                ("preproc", preprocessor),
-                (
-                    "clf",
-                    HistGradientBoostingClassifier(max_iter=500, monotonic_cst=montone_constraints),
-                ),
-            ]
-        )
-        params = {"clf__max_depth": [1, 3, 5], "clf__learning_rate": [0.5, 0.1, 0.01]}
+    if scoring == "precision_at_thresholds":
+        from sklearn.metrics import make_scorer
 
-    if model_type == "RandomForest":
+        # Not get_fast_precision_at_thresholds, which breaks ties differently. The scorer is
+        # called on predict()'s 0/1 labels, where almost every prediction is tied.
+        return make_scorer(get_precision_at_thresholds, greater_is_better=True)
+    return scoring
 
-        """
-            Enforcing that all features have a positive relationship with outcome because why not
-        """
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
 
-        montone_constraints = [1 for i in np.arange(len(numeric_model_features))]
-        pipe = Pipeline(
-            [
-                ("preproc", preprocessor),
-                ("clf", RandomForestClassifier(n_estimators=100, n_jobs=n_jobs)),
-            ]
-        )
-        params = {"clf__max_features": [0.1, 0.5], "clf__max_depth": [3, 5, None]}
+def get_model_search_clf(
+    model_type,
+    numeric_model_features,
+    categorical_model_features,
+    n_groups=3,
+    n_jobs=1,
+    search_cache_dir=None,
+    narrow_search=False,
+    shared_preprocessing=False,
+):
+
+    """
+    Returns: 
+        - GridSearch or RandomSearch estimator that implements fit() and get_best_estimator_. Also has GroupKFold cv strategy
+        - If search_cache_dir is given, grid searches are CachedGridSearchCV that store results.
+          The staged and random searches are not cached, and warn if search_cache_dir or
+          narrow_search is given.
+        - If shared_preprocessing, the search expects data run through get_model_preprocessor
+        - The estimator, grid and scoring of model_type are those of MODEL_SPECS
+        - Every fit of a candidate also records TELEMETRY_SCORERS, see get_search_telemetry
+    """
+    from sklearn.pipeline import Pipeline
+    from sklearn.model_selection import GridSearchCV, RandomizedSearchCV, StratifiedGroupKFold
+    from estimators import CachedGridSearchCV, PrebinnedSearchCV, StagedGridSearchCV
 
-    if model_type == "HistGBM_randomCV":
+    spec = get_model_spec(model_type)
 
-        from scipy.stats import lognorm, randint
+    estimator_params = spec["estimator_params"]
+    if callable(estimator_params):
+        estimator_params = estimator_params(numeric_model_features, n_jobs)
+    clf = _import(spec["estimator"])(**estimator_params)
 
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
-        pipe = Pipeline(
-            [("preproc", preprocessor), ("clf", HistGradientBoostingClassifier(max_iter=500))]
-        )
+    params = spec["param_grid"]
+    if callable(params):
+        params = params()
+    # The searches refit on "score"; the telemetry metrics are only recorded
+    scoring = {"score": _get_scorer(spec["scoring"]), **TELEMETRY_SCORERS}
 
-        params = {
-            "clf__max_depth": [None, 2, 3, 4],
-            "clf__learning_rate": lognorm(s=0.5, scale=np.exp(-4), loc=np.exp(-7)),
-            "clf__max_leaf_nodes": randint(5, 31),
-            "clf__min_samples_leaf": randint(2, 20),
-        }
+    preprocessor = _get_preprocessor(
+        numeric_model_features, categorical_model_features, standard_scale=spec["standard_scale"]
+    )
+    if spec["search"] == "prebinned":
+        pipe = Pipeline([("clf", clf)])
+    else:
+        pipe = Pipeline([("preproc", preprocessor), ("clf", clf)])
 
-    if model_type == "HistGBM_precision_opt":
+    gkf = StratifiedGroupKFold(n_splits=n_groups)
 
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
-        )
-        pipe = Pipeline(
-            [
-                ("preproc", preprocessor),
-                (
-                    "clf",
-                    HistGradientBoostingClassifier(
-                        max_iter=500,
-                        scoring=make_scorer(get_precision_at_thresholds, greater_is_better=True),
-                    ),
-                ),
-            ]
-        )
-        params = {"clf__max_depth": [1, 3, 5], "clf__learning_rate": [0.5, 0.1, 0.01]}
+    if shared_preprocessing:
+        preprocessor = "passthrough"
+        if "preproc" in pipe.named_steps:
+            pipe.set_params(preproc="passthrough")
 
-    if model_type == "logistic":
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=True
-        )
-        pipe = Pipeline(
-            [
-                ("preproc", preprocessor),
-                ("clf", LogisticRegression(penalty="elasticnet", solver="saga", max_iter=500)),
-            ]
-        )
-        params = {
-            "clf__l1_ratio": [0.1, 0.5, 0.9],
-            "clf__C": [0.0001, 0.001, 0.01, 0.1, 1, 10, 100],
-        }
-    if model_type == "nonnegative_LPM":
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=True
-        )
-        pipe = Pipeline([("preproc", preprocessor), ("clf", ElasticNet(positive=True))])
-        params = {"clf__l1_ratio": [0.1, 0.5, 0.9], "clf__alpha": [0.01, 1, 10, 500, 1000, 10000]}
-        scoring_func = "roc_auc"
-    if model_type == "dummy":
-        from sklearn.dummy import DummyClassifier
-
-        preprocessor = _get_preprocessor(
-            numeric_model_features, categorical_model_features, standard_scale=False
+    if search_cache_dir is None:
+        grid_search_cls = GridSearchCV
+    else:
+        grid_search_cls = partial(
+            CachedGridSearchCV,
+            cache_dir=search_cache_dir,
+            cache_features=numeric_model_features + categorical_model_features,
+            cache_tag=model_type,
+            narrow_search=narrow_search,
         )
-        pipe = Pipeline([("preproc", preprocessor), ("clf", DummyClassifier())])
-        params = {
-            "clf__strategy": ["prior", "uniform"],
-        }
 
-    gkf = StratifiedGroupKFold(n_splits=n_groups)
+    if spec["search"] in ["staged", "random"] and (search_cache_dir is not None or narrow_search):
+        warnings.warn(
+            f"{model_type} uses a {spec['search']} search, which does not support "
+            f"search_cache_dir or narrow_search; they are ignored"
+        )
 
-    if model_type == "HistGBM_precision_opt":
-        model = GridSearchCV(
+    if spec["search"] == "staged":
+        model = StagedGridSearchCV(
             pipe,
             params,
+            spec["n_iter_grid"],
+            n_iter_param=spec["n_iter_param"],
+            scoring=spec["scoring"],
             cv=gkf,
             n_jobs=n_jobs,
-            scoring=make_scorer(get_precision_at_thresholds, greater_is_better=True),
         )
-    elif model_type == "HistGBM_randomCV":
+    elif spec["search"] == "random":
         model = RandomizedSearchCV(
-            pipe, params, cv=gkf, n_jobs=n_jobs, scoring=scoring_func, n_iter=50
+            pipe, params, cv=gkf, n_jobs=n_jobs, scoring=scoring, refit="score", n_iter=50
+        )
+    elif spec["search"] == "prebinned":
+        model = PrebinnedSearchCV(
+            preprocessor,
+            grid_search_cls(
+                pipe, params, cv=gkf, n_jobs=n_jobs, scoring=scoring, refit="score"
+            ),
         )
-
     else:
-
-        model = GridSearchCV(pipe, params, cv=gkf, n_jobs=n_jobs, scoring=scoring_func)
+        model = grid_search_cls(
+            pipe, params, cv=gkf, n_jobs=n_jobs, scoring=scoring, refit="score"
+        )
 
     return model
 
 
+def get_model_preprocessor(model_type, numeric_model_features, categorical_model_features):
+    """
+        Returns an unfitted copy of the preprocessing that get_model_search_clf uses for model_type
+    """
+    return _get_preprocessor(
+        numeric_model_features,
+        categorical_model_features,
+        standard_scale=get_model_spec(model_type)["standard_scale"],
+    )
+
+
+def get_preprocessed_columns(preprocessor, numeric_model_features, feature_subset):
+    """
+        Returns the positions, in the output of a preprocessor fitted on numeric_model_features, of
+        the columns that the same preprocessor fitted on feature_subset alone would output, in the
+        same order. This holds because the imputer and scaler treat every column on its own.
+    """
+    imputer = preprocessor.named_transformers_["numeric"].named_steps["imputer"]
+
+    # The imputer drops features that are entirely missing in the training data
+    kept_features = [
+        f for f, stat in zip(numeric_model_features, imputer.statistics_) if not np.isnan(stat)
+    ]
+    positions = {f: ix for ix, f in enumerate(kept_features)}
+
+    indicator_positions = {}
+    if imputer.indicator_ is not None:
+        indicator_positions = {
+            numeric_model_features[f_ix]: len(kept_features) + k
+            for k, f_ix in enumerate(imputer.indicator_.features_)
+        }
+
+    return [positions[f] for f in feature_subset if f in positions] + [
+        indicator_positions[f] for f in feature_subset if f in indicator_positions
+    ]
+
+
+def get_feature_matrix(df, feature_list):
+    """
+        Returns the feature columns of df as float32, so the preprocessors keep the training
+        matrices in float32 instead of widening the compact count dtypes to float64
+    """
+    return df[feature_list].astype(np.float32)
+
+
+def get_constant_and_duplicate_columns(X):
+    """
+        Compares the columns of X by their bytes in one pass. Returns a boolean mask of the
+        constant columns and, for every column, the position of the first column with identical
+        values. Missing values compare equal to each other but not to any number.
+    """
+    values = np.array(X, dtype=np.float64)
+    # Make -0.0 and 0.0, and all NaN payloads, identical byte for byte
+    values += 0.0
+    values[np.isnan(values)] = np.nan
+    bits = values.view(np.uint64)
+
+    is_constant = (bits == bits[:1]).all(axis=0)
+
+    columns = np.ascontiguousarray(bits.T)
+    columns = columns.view(np.dtype((np.void, columns.itemsize * columns.shape[1]))).ravel()
+    _, first_ix, inverse = np.unique(columns, return_index=True, return_inverse=True)
+    return is_constant, first_ix[inverse.ravel()]
+
+
 def _get_pseudo_id(data, random_state):
 
     import random
@@ -245,3 +495,45 @@ def get_precision_at_thresholds(y_true, y_pred, thresholds=[0.01, 0.05, 0.02, 0.
     return sum([get_precision_at_x_pct(y_flag, y_pred, thresh) for thresh in thresholds]) / len(
         thresholds
     )
+
+
+def get_fast_precision_at_thresholds(y_true, y_pred, thresholds=[0.01, 0.05, 0.02, 0.1]):
+    """
+        Average precision at thresholds like get_precision_at_thresholds, but only the top
+        int(max(thresholds) * n) predictions are sorted (after one partition) and every threshold
+        is read off one cumulative sum of the flags.
+        Tied predictions are taken in order of position. get_precision_at_thresholds takes them
+        in the arbitrary order of argsort, so the two scores are only equal when no tie crosses a
+        threshold's cutoff; on 0/1 predictions they differ. Raises if a threshold flags no rows.
+
+        y_pred can also be a 2-D array with one prediction vector per row, in which case an array
+        with the score of every row is returned.
+    """
+    y_flag = np.asarray(y_true) >= 1
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    batched = y_pred.ndim == 2
+    y_pred = np.atleast_2d(y_pred)
+
+    n_rows = y_pred.shape[1]
+    precision_ranks = np.array([int(thresh * n_rows) for thresh in thresholds])
+    if (precision_ranks == 0).any():
+        raise ValueError(
+            f"thresholds {thresholds} need at least {1 / min(thresholds):.0f} rows, got {n_rows}"
+        )
+    max_rank = precision_ranks.max()
+
+    # The max_rank-th highest prediction of every row. All the predictions above it are in the
+    # top, and the ties with it fill the remaining places in order of position.
+    cutoffs = -np.partition(-y_pred, max_rank - 1, axis=1)[:, max_rank - 1 : max_rank]
+    is_tied = y_pred == cutoffs
+    n_tied_in_top = max_rank - (y_pred > cutoffs).sum(axis=1, keepdims=True)
+    in_top = (y_pred > cutoffs) | (is_tied & (np.cumsum(is_tied, axis=1) <= n_tied_in_top))
+    top_ix = np.nonzero(in_top)[1].reshape(len(y_pred), max_rank)
+    top_preds = np.take_along_axis(y_pred, top_ix, axis=1)
+    top_ix = np.take_along_axis(top_ix, np.argsort(-top_preds, axis=1, kind="stable"), axis=1)
+
+    true_positives = np.cumsum(y_flag[top_ix], axis=1)
+    precisions = true_positives[:, precision_ranks - 1] / precision_ranks
+    scores = precisions.mean(axis=1)
+
+    return scores if batched else scores[0]
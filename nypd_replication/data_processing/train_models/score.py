@@ -0,0 +1,194 @@
+import numpy as np
+import os
+import sys
+import glob
+import joblib
+import argparse
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+# The saved models contain estimators from estimators.py, which need to be importable to load them
+import estimators
+
+sys.path.append("../..")
+from evaluation_utils import QuantileSketch
+
+ID_COLS = ["tax_id", "observation_date"]
+
+
+def load_model_artifacts(model_dir):
+
+    model_artifacts = [joblib.load(p) for p in sorted(glob.glob(f"{model_dir}/*.joblib"))]
+    if len(model_artifacts) == 0:
+        raise FileNotFoundError(f"no saved models found in {model_dir}")
+
+    for model_artifact in model_artifacts:
+        print(
+            "loaded",
+            model_artifact["pred_col"],
+            "trained on data with fingerprint",
+            model_artifact["training_fingerprint"],
+        )
+    return model_artifacts
+
+
+def score_in_chunks(
+    features_path, model_artifacts, scores_path, batch_size=100000, sketch_size=None
+):
+
+    """
+        First pass: reads the features parquet (a file or a year-partitioned dataset) batch_size
+        rows at a time, predicts with every model and appends the scores to scores_path. Only the
+        id columns and the features the models use are read. Returns the distinct scores of every
+        model by pred_year, in ascending order, and how many rows have each of them, used for
+        percentile ranks.
+        Ranking against every score keeps them all in memory until the end of the pass, 8 bytes
+        per row and model. With sketch_size, each model and year is summarized by a QuantileSketch
+        of about sketch_size * log2(n / sketch_size) scores instead, so memory no longer grows
+        with the number of rows, and every percentile rank is within max_rank_error / n of the
+        exact one.
+    """
+    feature_cols = sorted(set(c for m in model_artifacts for c in m["feature_list"]))
+    features_dataset = ds.dataset(features_path, format="parquet", partitioning="hive")
+
+    missing_cols = set(feature_cols) - set(features_dataset.schema.names)
+    if len(missing_cols) > 0:
+        raise ValueError(f"features are missing columns the models were trained on: {missing_cols}")
+
+    scores_by_year = {m["pred_col"]: {} for m in model_artifacts}
+    sketches_by_year = {m["pred_col"]: {} for m in model_artifacts}
+    writer = None
+    for batch in features_dataset.to_batches(columns=ID_COLS + feature_cols, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        chunk = batch.to_pandas()
+        scores = chunk[ID_COLS].copy()
+        scores["pred_year"] = scores["observation_date"].dt.year
+
+        for model_artifact in model_artifacts:
+            pred_col = model_artifact["pred_col"]
+            scores[pred_col] = model_artifact["model"].predict_proba(chunk)[:, 1]
+            for pred_year, year_scores in scores.groupby("pred_year")[pred_col]:
+                if sketch_size is None:
+                    scores_by_year[pred_col].setdefault(pred_year, []).append(year_scores.values)
+                else:
+                    sketches_by_year[pred_col].setdefault(
+                        pred_year, QuantileSketch(sketch_size)
+                    ).update(year_scores.values)
+
+        scores_table = pa.Table.from_pandas(scores, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(scores_path, scores_table.schema)
+        writer.write_table(scores_table)
+
+    if writer is not None:
+        writer.close()
+
+    if sketch_size is not None:
+        for pred_col, pred_col_sketches in sketches_by_year.items():
+            for pred_year, sketch in sorted(pred_col_sketches.items()):
+                print(
+                    f"{pred_col} {pred_year}: percentile ranks within "
+                    f"{sketch.max_rank_error / sketch.n:.2g} of the exact ones"
+                )
+        return {
+            pred_col: {
+                pred_year: sketch.get_weighted_scores()
+                for pred_year, sketch in pred_col_sketches.items()
+            }
+            for pred_col, pred_col_sketches in sketches_by_year.items()
+        }
+
+    return {
+        pred_col: {
+            pred_year: np.unique(np.concatenate(year_scores), return_counts=True)
+            for pred_year, year_scores in pred_col_scores.items()
+        }
+        for pred_col, pred_col_scores in scores_by_year.items()
+    }
+
+
+def get_percentile_ranks(scores, distinct_scores, counts):
+
+    """
+        Same as rank(pct=True) with the default "average" tie method, computed against the
+        distinct scores of the whole year, in ascending order, and how many rows have each
+    """
+    n_below_or_tied = np.append(0, np.cumsum(counts))
+    n_below = n_below_or_tied[np.searchsorted(distinct_scores, scores, side="left")]
+    n_below_or_tied = n_below_or_tied[np.searchsorted(distinct_scores, scores, side="right")]
+    return (n_below + (n_below_or_tied - n_below + 1) / 2) / np.sum(counts)
+
+
+def write_percentile_ranks(scores_path, distinct_scores_by_year, output_path, batch_size=100000):
+
+    """
+        Second pass: reads the scores back batch_size rows at a time and adds a `<pred_col>__pct`
+        column with the percentile rank of every score within its pred_year
+    """
+    writer = None
+    for batch in pq.ParquetFile(scores_path).iter_batches(batch_size=batch_size):
+        scores = batch.to_pandas()
+        for pred_col, distinct_scores in distinct_scores_by_year.items():
+            scores[f"{pred_col}__pct"] = np.nan
+            for pred_year, year_ix in scores.groupby("pred_year").indices.items():
+                scores.loc[scores.index[year_ix], f"{pred_col}__pct"] = get_percentile_ranks(
+                    scores[pred_col].values[year_ix], *distinct_scores[pred_year]
+                )
+
+        scores_table = pa.Table.from_pandas(scores, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, scores_table.schema)
+        writer.write_table(scores_table)
+
+    if writer is not None:
+        writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--features",
+        default="../create_features_and_outcomes/output/features.parquet",
+        help="parquet with the features of the observations to score",
+    )
+    parser.add_argument(
+        "--model_dir",
+        default="output/sustained_complaints/models",
+        help="directory with the models saved by train_models.py --save_models",
+    )
+    parser.add_argument(
+        "--output", default="output/scores.parquet", help="where to write the risk scores"
+    )
+    parser.add_argument(
+        "--batch_size", type=int, default=100000, help="rows scored at a time (default: 100000)"
+    )
+    parser.add_argument(
+        "--sketch_size",
+        type=int,
+        default=None,
+        help="rank against a quantile sketch of this size per model and year, for bounded memory",
+    )
+
+    args = parser.parse_args()
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir != "" and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    model_artifacts = load_model_artifacts(args.model_dir)
+
+    scores_path = f"{args.output}.unranked"
+    distinct_scores_by_year = score_in_chunks(
+        args.features,
+        model_artifacts,
+        scores_path,
+        batch_size=args.batch_size,
+        sketch_size=args.sketch_size,
+    )
+    write_percentile_ranks(
+        scores_path, distinct_scores_by_year, args.output, batch_size=args.batch_size
+    )
+    os.remove(scores_path)
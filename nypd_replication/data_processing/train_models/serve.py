@@ -0,0 +1,237 @@
+import pandas as pd
+import numpy as np
+import sys
+import json
+import asyncio
+import argparse
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+from score import load_model_artifacts, get_percentile_ranks
+
+sys.path.append("../create_features_and_outcomes")
+from create_features_and_outcomes import get_features_as_of
+
+
+class RiskScorer:
+
+    """
+        Holds the saved models, the cleaned allegation and lawsuit tables and the scores of the
+        latest cohort in memory. refresh() computes the features of every officer as of a date in
+        one pass over the event tables, so a request only has to look its officers up.
+        Only the tax_ids in roster_tax_ids are scored.
+    """
+
+    def __init__(self, model_artifacts, allegations, lawsuits, cohort_scores, roster_tax_ids):
+
+        self.model_artifacts = model_artifacts
+        self.allegations = allegations
+        self.lawsuits = lawsuits
+        self.cohort_scores = cohort_scores
+        self.roster_tax_ids = pd.Index(np.unique(np.asarray(roster_tax_ids, dtype=np.int64)))
+        self.as_of = None
+
+    def refresh(self, as_of):
+
+        features = get_features_as_of(as_of, self.allegations, self.lawsuits, verbose=False)
+        # Officers without any events in the windows get no row, which means all counts are 0
+        features = features.drop(columns=["observation_date"])
+        features.index = features.index.astype(np.int64)
+        features = features.reindex(self.roster_tax_ids, fill_value=0)
+
+        scores = {}
+        for model_artifact in self.model_artifacts:
+            pred_col = model_artifact["pred_col"]
+            X = features.reindex(columns=model_artifact["feature_list"]).fillna(0)
+            phat = model_artifact["model"].predict_proba(X)[:, 1]
+            scores[pred_col] = phat
+            scores[f"{pred_col}__pct"] = get_percentile_ranks(phat, *self.cohort_scores[pred_col])
+
+        # Swapped in as one tuple so requests never see a half refreshed state
+        self._state = (str(as_of.date()), features.index, scores)
+        self.as_of = as_of
+
+    def score(self, tax_ids):
+
+        """
+            Returns {tax_id: result} for a batch of tax_ids, where the result of a tax_id that is
+            not on the roster is None
+        """
+        as_of, officer_index, scores = self._state
+
+        positions = officer_index.get_indexer(tax_ids)
+        on_roster = positions != -1
+        roster_tax_ids = [t for t, is_on_roster in zip(tax_ids, on_roster) if is_on_roster]
+
+        results = {t: None for t in tax_ids}
+        results.update({t: {"tax_id": t, "as_of": as_of} for t in roster_tax_ids})
+        for col, col_scores in scores.items():
+            for t, score in zip(roster_tax_ids, col_scores[positions[on_roster]].tolist()):
+                results[t][col] = score
+
+        return results
+
+
+def load_cohort_scores(scores_path, pred_cols):
+
+    """
+        Returns the distinct scores of the latest pred_year in the output of score.py, in
+        ascending order, and how many rows have each of them
+    """
+    scores = pd.read_parquet(scores_path, columns=["pred_year"] + pred_cols)
+    latest_cohort = scores[scores["pred_year"] == scores["pred_year"].max()]
+    print("ranking against the", latest_cohort["pred_year"].iloc[0], "cohort")
+    return {c: np.unique(latest_cohort[c].values, return_counts=True) for c in pred_cols}
+
+
+def _today():
+    return pd.Timestamp(datetime.today().date())
+
+
+class RiskService:
+
+    """
+        Minimal asyncio HTTP server for GET /risk?tax_id=<tax_id>. Requests that arrive within
+        batch_window_ms of each other are scored together in a worker thread, up to max_batch_size.
+    """
+
+    def __init__(self, scorer, batch_window_ms=2, max_batch_size=256):
+
+        self.scorer = scorer
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+
+    async def serve(self, host, port):
+
+        self.queue = asyncio.Queue()
+        self.scorer.refresh(_today())
+        workers = [
+            asyncio.ensure_future(self._batch_worker()),
+            asyncio.ensure_future(self._refresh_worker()),
+        ]
+        server = await asyncio.start_server(self._handle, host, port)
+        print(f"serving on http://{host}:{port}/risk?tax_id=<tax_id>")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _refresh_worker(self):
+
+        """
+            Recomputes the features once the date changes. Requests keep being served from the
+            previous day's scores until the refresh is done.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(60)
+            if _today() != self.scorer.as_of:
+                await loop.run_in_executor(None, self.scorer.refresh, _today())
+
+    async def _batch_worker(self):
+
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            tax_ids = list(dict.fromkeys(tax_id for tax_id, _ in pending))
+            try:
+                results = await loop.run_in_executor(None, self.scorer.score, tax_ids)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            for tax_id, future in pending:
+                future.set_result(results[tax_id])
+
+    async def _handle(self, reader, writer):
+
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+
+            method, target = request_line.decode().split(" ")[:2]
+            url = urlparse(target)
+            if method != "GET" or url.path != "/risk":
+                status, body = "404 Not Found", {"error": "use GET /risk?tax_id=<tax_id>"}
+            else:
+                try:
+                    tax_id = int(parse_qs(url.query)["tax_id"][0])
+                except (KeyError, ValueError):
+                    status, body = "400 Bad Request", {"error": "tax_id must be an integer"}
+                else:
+                    future = asyncio.get_running_loop().create_future()
+                    self.queue.put_nowait((tax_id, future))
+                    status, body = "200 OK", await future
+                    if body is None:
+                        status = "404 Not Found"
+                        body = {"error": f"tax_id {tax_id} is not on the roster"}
+        except Exception as e:
+            status, body = "500 Internal Server Error", {"error": str(e)}
+
+        payload = json.dumps(body).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+            + payload
+        )
+        await writer.drain()
+        writer.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_dir",
+        default="output/sustained_complaints/models",
+        help="directory with the models saved by train_models.py --save_models",
+    )
+    parser.add_argument(
+        "--cohort_scores",
+        default="output/scores.parquet",
+        help="output of score.py; its latest pred_year is the cohort the percentiles are ranked in",
+    )
+    parser.add_argument(
+        "--career_dates",
+        default="../create_career_start_end_dates/output/career_dates.parquet",
+        help="officers whose tax_id is not in this table get a 404",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--batch_window_ms",
+        type=float,
+        default=2,
+        help="how long to wait for concurrent requests to score together (default: 2)",
+    )
+
+    args = parser.parse_args()
+
+    model_artifacts = load_model_artifacts(args.model_dir)
+    cohort_scores = load_cohort_scores(
+        args.cohort_scores, [m["pred_col"] for m in model_artifacts]
+    )
+
+    allegations = pd.read_parquet(
+        "../clean_complaints_and_allegations/output/clean_allegations.parquet"
+    )
+    lawsuits = pd.read_parquet("../clean_lawsuits/output/clean_lawsuits.parquet")
+    roster_tax_ids = pd.read_parquet(args.career_dates, columns=["tax_id"])["tax_id"]
+
+    scorer = RiskScorer(model_artifacts, allegations, lawsuits, cohort_scores, roster_tax_ids)
+    service = RiskService(scorer, batch_window_ms=args.batch_window_ms)
+    asyncio.run(service.serve(args.host, args.port))
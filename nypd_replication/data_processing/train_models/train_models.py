@@ -1,10 +1,23 @@
 import pandas as pd
 import numpy as np
 import os
+import sys
+import joblib
+from time import time
 from datetime import datetime
 from ml_utils import *
 from ml_utils import _get_pseudo_id
 import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sklearn.model_selection import GroupKFold
+
+sys.path.append("../create_features_and_outcomes")
+from create_features_and_outcomes import (
+    apply_dtype_policy,
+    read_year_partitioned_parquet,
+    write_year_partitioned_parquet,
+)
 
 
 def get_substantiated_complaint_features(df):
@@ -30,13 +43,185 @@ def get_all_complaint_cols(df):
     return total_count_cols + allegation_cols
 
 
-def train_model(active_officer_df, target, feature_list=None, mc_iters=1, n_jobs=1):
+def get_feature_lists(df):
+
+    return {
+        "phat": df.filter(like="past_").columns.tolist(),
+        "phat__only_sus_complaints": get_substantiated_complaint_features(df),
+        "phat__only_complaints": get_all_complaint_cols(df),
+    }
+
+
+def prune_feature_lists(train_df, feature_lists):
+
+    """
+        Drops the columns that are constant in train_df, and the columns that duplicate an
+        earlier column of the same feature list, from every {pred_col: feature_list}. Constant
+        columns are never split on and the trees pick the first of identical columns, so the
+        tree models predict the same with the pruned lists.
+    """
+    all_features = list(dict.fromkeys(f for fl in feature_lists.values() for f in fl))
+    is_constant, first_ix = get_constant_and_duplicate_columns(train_df[all_features].values)
+    is_constant = dict(zip(all_features, is_constant))
+    duplicate_group = dict(zip(all_features, first_ix))
+
+    pruned_feature_lists = {}
+    for pred_col, feature_list in feature_lists.items():
+        constant_cols = [f for f in feature_list if is_constant[f]]
+        seen_groups = set()
+        pruned_feature_lists[pred_col] = []
+        duplicate_cols = []
+        for f in feature_list:
+            if is_constant[f]:
+                continue
+            if duplicate_group[f] in seen_groups:
+                duplicate_cols.append(f)
+                continue
+            seen_groups.add(duplicate_group[f])
+            pruned_feature_lists[pred_col].append(f)
+
+        print(
+            f"{pred_col}: dropped {len(constant_cols)} constant and {len(duplicate_cols)} "
+            f"duplicate columns, kept {len(pruned_feature_lists[pred_col])}"
+        )
+        print("  constant:", constant_cols)
+        print("  duplicate:", duplicate_cols)
+
+    return pruned_feature_lists
+
+
+def get_fold_telemetry(search, X_train, search_time, model_type, iteration, cv_group):
+
+    """
+        get_search_telemetry of a search fit on one outer fold, with the fold, the shape of its
+        training matrix and the wall time of the whole search including the refit
+    """
+    return get_search_telemetry(search).assign(
+        model_type=model_type,
+        iteration=iteration,
+        cv_group=cv_group,
+        n_rows=X_train.shape[0],
+        n_cols=X_train.shape[1],
+        search_time=search_time,
+    )
+
+
+def print_slowest_configurations(telemetry, n=10):
+
+    """
+        Prints the candidates with the highest mean fit time, averaged over the outer folds
+    """
+    group_cols = [c for c in ["pred_col", "fit_params"] if c in telemetry.columns]
+    fits = telemetry.drop_duplicates(["iteration", "cv_group"] + group_cols)
+    slowest = (
+        fits.groupby(group_cols)
+        .agg(
+            mean_fit_time=("mean_fit_time", "mean"),
+            mean_score_time=("mean_score_time", "mean"),
+            n_iter=("n_iter", "mean"),
+            peak_rss_mb=("peak_rss_mb", "max"),
+            n_folds=("cv_group", "size"),
+        )
+        .sort_values("mean_fit_time", ascending=False)
+        .head(n)
+    )
+    total_search_time = fits.groupby(["iteration", "cv_group"] + group_cols[:-1])[
+        "search_time"
+    ].first()
+    print(f"total search time {total_search_time.sum():.1f} s, slowest configurations:")
+    with pd.option_context(
+        "display.width", 250, "display.max_columns", None, "display.max_colwidth", None
+    ):
+        print(slowest)
+
+
+def get_checkpoint_fingerprint(data_fingerprint, target, feature_list, prune_features, test_ix):
+
+    """
+        Fingerprint of everything the predictions of one (iteration, cv_group) block depend on.
+        data_fingerprint covers the ids, features and outcome of the whole table, and test_ix
+        the rows of the fold.
+    """
+    return get_data_fingerprint(
+        np.array([data_fingerprint, target, repr(feature_list), repr(prune_features)]), test_ix
+    )
+
+
+def _read_checkpoint(checkpoint_dir, iteration, cv_group, fingerprint):
+
+    """
+        Returns None if there is no checkpoint of the block, or if it was written with a different
+        fingerprint, i.e. for other data, target, features or folds
+    """
+    if checkpoint_dir is None:
+        return None
+
+    checkpoint_path = f"{checkpoint_dir}/iteration_{iteration}__cv_group_{cv_group}.parquet"
+    if not os.path.exists(checkpoint_path):
+        return None
+
+    checkpoint = pq.read_table(checkpoint_path)
+    checkpoint_fingerprint = (checkpoint.schema.metadata or {}).get(b"checkpoint_fingerprint")
+    if checkpoint_fingerprint != fingerprint.encode():
+        print(f"ignoring {checkpoint_path}, it was written for different data or settings")
+        return None
+
+    return checkpoint.to_pandas()
+
+
+def _write_checkpoint(predictions, checkpoint_dir, iteration, cv_group, fingerprint):
+
+    """
+        Writes to a temporary file first so a killed run never leaves a partial block behind.
+        The fingerprint is stored in the parquet metadata.
+    """
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    checkpoint_path = f"{checkpoint_dir}/iteration_{iteration}__cv_group_{cv_group}.parquet"
+    table = pa.Table.from_pandas(predictions, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, b"checkpoint_fingerprint": fingerprint.encode()}
+    )
+    pq.write_table(table, f"{checkpoint_path}.tmp")
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+
+def train_model(
+    active_officer_df,
+    target,
+    feature_list=None,
+    mc_iters=1,
+    n_jobs=1,
+    model_type=DEFAULT_MODEL_TYPE,
+    checkpoint_dir=None,
+    search_cache_dir=None,
+    narrow_search=False,
+    prune_features=False,
+    telemetry=None,
+):
+
+    """
+        If checkpoint_dir is given, the predictions for every (iteration, cv_group) block are
+        written there as soon as they are computed, and blocks that already exist are read back
+        instead of retrained. Iteration i always uses the same pseudo-ID seed, so raising mc_iters
+        only trains the new iterations. Blocks whose get_checkpoint_fingerprint does not match
+        are retrained and overwritten.
+        If prune_features, constant and duplicate columns of each training split are left out.
+        If telemetry is a list, the get_search_telemetry of every fold is appended to it.
+    """
 
     if feature_list is None:
         feature_list = active_officer_df.filter(like="past_").columns.tolist()
 
     random_state = 0
 
+    if checkpoint_dir is not None:
+        data_fingerprint = get_data_fingerprint(
+            active_officer_df[["tax_id", "observation_date"] + feature_list],
+            active_officer_df[target],
+        )
+
     all_predictions = []
     for i in np.arange(mc_iters):
         print(f"iteration {i}")
@@ -51,24 +236,57 @@ def train_model(active_officer_df, target, feature_list=None, mc_iters=1, n_jobs
         j = 0
         for train_ix, test_ix in gkf.split(temp_data, groups=temp_data["pseudo_ID"]):
             print(f"group {j}")
+
+            fingerprint = None
+            if checkpoint_dir is not None:
+                fingerprint = get_checkpoint_fingerprint(
+                    data_fingerprint, target, feature_list, prune_features, test_ix
+                )
+            checkpointed_predictions = _read_checkpoint(checkpoint_dir, i, j, fingerprint)
+            if checkpointed_predictions is not None:
+                print("loaded from checkpoint")
+                all_predictions.append(checkpointed_predictions)
+                j += 1
+                continue
+
             temp_train = temp_data.iloc[train_ix].reset_index()
 
             temp_test = temp_data.iloc[test_ix].reset_index()
 
-            temp_est = get_model_search_clf("HistGBM", feature_list, [], n_jobs=n_jobs)
-            temp_est.fit(temp_train, (temp_train[target] >= 1) * 1.0, groups=temp_train["tax_id"])
-
+            fold_feature_list = feature_list
+            if prune_features:
+                fold_feature_list = prune_feature_lists(temp_train, {"phat": feature_list})["phat"]
+
+            temp_est = get_model_search_clf(
+                model_type,
+                fold_feature_list,
+                [],
+                n_jobs=n_jobs,
+                search_cache_dir=search_cache_dir,
+                narrow_search=narrow_search,
+            )
+            X_train = get_feature_matrix(temp_train, fold_feature_list)
+            start_time = time()
+            temp_est.fit(X_train, (temp_train[target] >= 1) * 1.0, groups=temp_train["tax_id"])
+            if telemetry is not None:
+                telemetry.append(
+                    get_fold_telemetry(temp_est, X_train, time() - start_time, model_type, i, j)
+                )
+
+            X_test = get_feature_matrix(temp_test, fold_feature_list)
             if hasattr(temp_est, "predict_proba"):
-                temp_test["phat"] = temp_est.predict_proba(temp_test)[:, 1]
+                temp_test["phat"] = temp_est.predict_proba(X_test)[:, 1]
             else:
-                temp_test["phat"] = temp_est.predict(temp_test)
+                temp_test["phat"] = temp_est.predict(X_test)
 
             temp_test["cv_group"] = j
             temp_test["iteration"] = i
-            j += 1
 
             record_cols = ["tax_id", "observation_date", "phat", "iteration", "cv_group"]
+            if checkpoint_dir is not None:
+                _write_checkpoint(temp_test[record_cols], checkpoint_dir, i, j, fingerprint)
             all_predictions.append(temp_test[record_cols])
+            j += 1
 
     all_preds = pd.concat(all_predictions)
 
@@ -77,13 +295,245 @@ def train_model(active_officer_df, target, feature_list=None, mc_iters=1, n_jobs
     return all_preds
 
 
-def limit_observations_to_active_officers(_main_table):
+def train_model_feature_sets(
+    active_officer_df,
+    target,
+    feature_lists,
+    mc_iters=1,
+    n_jobs=1,
+    model_type=DEFAULT_MODEL_TYPE,
+    checkpoint_dirs=None,
+    search_cache_dir=None,
+    narrow_search=False,
+    prune_features=False,
+    telemetry=None,
+):
+
+    """
+        Same as calling train_model once for every {pred_col: feature_list} in feature_lists, but
+        the pseudo-IDs, fold splits and preprocessing are computed once per fold and shared by all
+        the feature sets, which are fit on column subsets of the preprocessed matrix.
+        Returns the averaged predictions of every feature set as columns, aligned row by row with
+        active_officer_df.
+        If prune_features, the feature lists are pruned once per fold by prune_feature_lists and
+        only the columns some pruned list uses are preprocessed.
+        If telemetry is a list, the get_search_telemetry of every fold and feature set is
+        appended to it.
+        Checkpoints are read and written per feature set as in train_model.
+    """
+
+    if checkpoint_dirs is None:
+        checkpoint_dirs = {pred_col: None for pred_col in feature_lists}
+
+    if any(checkpoint_dir is not None for checkpoint_dir in checkpoint_dirs.values()):
+        data_fingerprint = get_data_fingerprint(
+            active_officer_df[
+                ["tax_id", "observation_date"]
+                + list(dict.fromkeys(f for fl in feature_lists.values() for f in fl))
+            ],
+            active_officer_df[target],
+        )
+
+    y = ((active_officer_df[target] >= 1) * 1.0).values
+    groups = active_officer_df["tax_id"].values
+
+    random_state = 0
+
+    phat_sums = {pred_col: np.zeros(len(active_officer_df)) for pred_col in feature_lists}
+    for i in np.arange(mc_iters):
+        print(f"iteration {i}")
+
+        # This is a hack to get around the fact that GroupKFold is deterministic function of the `group` labels
+        pseudo_id = _get_pseudo_id(active_officer_df, random_state + i)
+
+        gkf = GroupKFold(n_splits=3)
+
+        for j, (train_ix, test_ix) in enumerate(gkf.split(active_officer_df, groups=pseudo_id)):
+            print(f"group {j}")
+
+            preprocessor = None
+            for pred_col, feature_list in feature_lists.items():
+
+                fingerprint = None
+                if checkpoint_dirs[pred_col] is not None:
+                    fingerprint = get_checkpoint_fingerprint(
+                        data_fingerprint, target, feature_list, prune_features, test_ix
+                    )
+                checkpointed_predictions = _read_checkpoint(
+                    checkpoint_dirs[pred_col], i, j, fingerprint
+                )
+                if checkpointed_predictions is not None:
+                    print(pred_col, "loaded from checkpoint")
+                    phat_sums[pred_col][test_ix] += checkpointed_predictions["phat"].values
+                    continue
+
+                if preprocessor is None:
+                    fold_feature_lists = feature_lists
+                    if prune_features:
+                        fold_feature_lists = prune_feature_lists(
+                            active_officer_df.iloc[train_ix], feature_lists
+                        )
+                    all_features = list(
+                        dict.fromkeys(f for fl in fold_feature_lists.values() for f in fl)
+                    )
+
+                    preprocessor = get_model_preprocessor(model_type, all_features, [])
+                    X_train = preprocessor.fit_transform(
+                        get_feature_matrix(active_officer_df.iloc[train_ix], all_features)
+                    )
+                    X_test = preprocessor.transform(
+                        get_feature_matrix(active_officer_df.iloc[test_ix], all_features)
+                    )
+
+                feature_list = fold_feature_lists[pred_col]
+                cols = get_preprocessed_columns(preprocessor, all_features, feature_list)
+
+                temp_est = get_model_search_clf(
+                    model_type,
+                    feature_list,
+                    [],
+                    n_jobs=n_jobs,
+                    search_cache_dir=search_cache_dir,
+                    narrow_search=narrow_search,
+                    shared_preprocessing=True,
+                )
+                start_time = time()
+                temp_est.fit(X_train[:, cols], y[train_ix], groups=groups[train_ix])
+                if telemetry is not None:
+                    fold_telemetry = get_fold_telemetry(
+                        temp_est, X_train[:, cols], time() - start_time, model_type, i, j
+                    )
+                    telemetry.append(fold_telemetry.assign(pred_col=pred_col))
+
+                if hasattr(temp_est, "predict_proba"):
+                    phat = temp_est.predict_proba(X_test[:, cols])[:, 1]
+                else:
+                    phat = temp_est.predict(X_test[:, cols])
+                phat_sums[pred_col][test_ix] += phat
+
+                if checkpoint_dirs[pred_col] is not None:
+                    temp_preds = active_officer_df.iloc[test_ix][["tax_id", "observation_date"]]
+                    temp_preds = temp_preds.assign(phat=phat, iteration=i, cv_group=j)
+                    _write_checkpoint(temp_preds, checkpoint_dirs[pred_col], i, j, fingerprint)
+
+    all_preds = pd.DataFrame(
+        {pred_col: phat_sums[pred_col] / mc_iters for pred_col in feature_lists},
+        index=active_officer_df.index,
+    )
+
+    return all_preds
+
+
+def fit_and_save_final_model(
+    df,
+    target,
+    feature_list,
+    pred_col,
+    model_dir,
+    n_jobs=1,
+    model_type=DEFAULT_MODEL_TYPE,
+    prune_features=False,
+):
+
+    """
+        Fits the model search on every observation in df and saves the best estimator together with
+        its feature list and a fingerprint of the training data, so new observation dates can be
+        scored with score.py without retraining
+    """
+    print("fitting final model for", pred_col)
+    y = (df[target] >= 1) * 1.0
+
+    if prune_features:
+        feature_list = prune_feature_lists(df, {pred_col: feature_list})[pred_col]
+
+    est = get_model_search_clf(model_type, feature_list, [], n_jobs=n_jobs)
+    est.fit(get_feature_matrix(df, feature_list), y, groups=df["tax_id"])
+
+    model_artifact = {
+        "model": est.best_estimator_,
+        "feature_list": feature_list,
+        "pred_col": pred_col,
+        "target": target,
+        "model_type": model_type,
+        "training_fingerprint": get_data_fingerprint(df[feature_list], y),
+    }
+
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    joblib.dump(model_artifact, f"{model_dir}/{pred_col}.joblib")
+
+
+def backtest_model(
+    active_officer_df,
+    target,
+    feature_list,
+    n_jobs=1,
+    model_type="HistGBM_prebinned",
+    iters_per_year=50,
+    gap_years=0,
+):
+
+    """
+        Rolling-origin backtest: for every observation year t after the first, trains on the
+        observations of years < t - gap_years and predicts the observations of year t.
+        The first training window gets a full grid search of model_type, which has to be a
+        boosting model (see get_warm_start_iter_param). Every later year continues the previous
+        model with warm_start, adding iters_per_year trees fit on the extended window, instead of
+        refitting from scratch. The preprocessing (and, for HistGBM_prebinned, the HistBinner
+        codes) stays the one fit on the first window, so the earlier trees keep splitting on the
+        same values.
+        The outcomes span two years, so gap_years=1 leaves out training outcomes that were not
+        yet observed at the start of year t.
+        Returns the predictions aligned with active_officer_df, NaN for years without a model.
+    """
+    iter_param = get_warm_start_iter_param(model_type)
+    years = active_officer_df["observation_date"].dt.year
+    y = (active_officer_df[target] >= 1) * 1.0
+
+    phat = pd.Series(np.nan, index=active_officer_df.index)
+    model = None
+    for year in sorted(years.unique()):
+
+        train_mask = (years < year - gap_years).values
+        if not train_mask.any():
+            continue
+        test_mask = (years == year).values
+        X_train = get_feature_matrix(active_officer_df[train_mask], feature_list)
+
+        if model is None:
+            search = get_model_search_clf(model_type, feature_list, [], n_jobs=n_jobs)
+            search.fit(X_train, y[train_mask], groups=active_officer_df["tax_id"][train_mask])
+            model = search.best_estimator_
+            clf = model[-1]
+            # Turn off early stopping, so every added iteration is fit
+            if "early_stopping" in clf.get_params():
+                clf.set_params(early_stopping=False)
+            else:
+                clf.set_params(n_iter_no_change=None)
+            clf.set_params(warm_start=True)
+        else:
+            clf.set_params(**{iter_param: int(get_n_iter_used(clf)) + iters_per_year})
+            clf.fit(model[:-1].transform(X_train), y[train_mask])
+
+        n_trees = int(get_n_iter_used(clf))
+        print(f"year {year}: trained on {train_mask.sum()} observations, {n_trees} trees")
+        X_test = get_feature_matrix(active_officer_df[test_mask], feature_list)
+        phat[test_mask] = model.predict_proba(X_test)[:, 1]
+
+    return phat
+
+
+def limit_observations_to_active_officers(_main_table, career_dates=None):
 
     """
         Only keeps observations where the observation date is between career start and career end date. 
         Implicilty drops any rows where career start date is null
     """
-    career_dates = pd.read_parquet("../create_career_start_end_dates/output/career_dates.parquet")
+    if career_dates is None:
+        career_dates = pd.read_parquet(
+            "../create_career_start_end_dates/output/career_dates.parquet"
+        )
 
     main_table = pd.merge(
         _main_table, career_dates, left_on="tax_id", right_on="tax_id", how="left"
@@ -100,57 +550,204 @@ def limit_observations_to_active_officers(_main_table):
     return active_officer_df
 
 
+def get_observation_keys(df):
+
+    """
+        Packs (tax_id, observation_date) into one int64 that sorts the same way, with the tax_id
+        in the high bits and the days since 1970 (offset to be positive) in the low 20 bits
+    """
+    days = df["observation_date"].values.astype("datetime64[D]").astype(np.int64)
+    return (df["tax_id"].values.astype(np.int64) << 20) + (days + 2 ** 19)
+
+
+def find_sorted_positions(frame_keys, keys):
+
+    """
+        Returns the row position in the frame of every key and whether it was found, by binary
+        search over the sorted frame keys
+    """
+    order = np.argsort(frame_keys, kind="stable")
+    sorted_keys = frame_keys[order]
+    ix = np.searchsorted(sorted_keys, keys).clip(max=max(len(sorted_keys) - 1, 0))
+    found = sorted_keys[ix] == keys if len(sorted_keys) > 0 else np.zeros(len(keys), bool)
+    return order[ix], found
+
+
+def take_aligned(frame, positions, drop_cols):
+
+    """
+        Copies the rows at positions of every column but drop_cols in a single take
+    """
+    col_ix = [i for i, c in enumerate(frame.columns) if c not in drop_cols]
+    aligned = frame.iloc[positions, col_ix]
+    aligned.index = pd.RangeIndex(len(aligned))
+    return aligned
+
+
+def find_active_observations(main_table, career_dates):
+
+    """
+        Returns the row positions in main_table of the observations between the career start and
+        end date of their officer, in the order of main_table, and the career dates of each
+    """
+    career_positions, has_career = find_sorted_positions(
+        career_dates["tax_id"].values.astype(np.int64), main_table["tax_id"].values
+    )
+    candidates = np.flatnonzero(has_career)
+    careers = take_aligned(career_dates, career_positions[candidates], ["tax_id"])
+
+    observation_dates = main_table["observation_date"].iloc[candidates].reset_index(drop=True)
+    is_active = observation_dates.between(
+        careers["career_start_date"], careers["career_end_date"]
+    ).values
+    return candidates[is_active], take_aligned(careers, np.flatnonzero(is_active), [])
+
+
+def assemble_active_officer_table(main_table, features, outcomes, career_dates):
+
+    """
+        Builds the same table as merging main_table with the features and the outcomes and then
+        calling limit_observations_to_active_officers, without hash joins of the wide frames.
+
+        The active career mask is applied first, on the two id columns of main_table. The rows of
+        features and outcomes are then looked up by sorting their (tax_id, observation_date)
+        keys and binary searching them, and only the active rows are copied, once. As with the
+        left merges, active observations without a features or outcomes row get missing values.
+        The rows keep the order of main_table so the cross-validation splits are the same as
+        before.
+    """
+    active_positions, careers = find_active_observations(main_table, career_dates)
+
+    active_keys = get_observation_keys(main_table)[active_positions]
+    parts = [take_aligned(main_table, active_positions, [])]
+    for frame in [features, outcomes]:
+        positions, found = find_sorted_positions(get_observation_keys(frame), active_keys)
+        aligned = take_aligned(frame, positions, ["tax_id", "observation_date"])
+        if not found.all():
+            aligned = aligned.where(pd.Series(found, index=aligned.index), axis=0)
+        parts.append(aligned)
+    parts.append(careers)
+
+    active_officer_df = pd.concat(parts, axis=1, copy=False)
+    active_officer_df["officer_presumed_active"] = True
+    active_officer_df["year"] = active_officer_df["observation_date"].dt.year
+    return active_officer_df
+
+
 def train_model_and_write_predictions(
-    df, target, target_short_name, output_dir="output", mc_iters=1, n_jobs=1
+    df,
+    target,
+    target_short_name,
+    output_dir="output",
+    mc_iters=1,
+    n_jobs=1,
+    model_type=DEFAULT_MODEL_TYPE,
+    checkpoint=False,
+    search_cache=False,
+    narrow_search=False,
+    save_models=False,
+    prune_features=False,
 ):
 
-    print("training on", target)
-    all_feature_predictions = train_model(df, target=target, mc_iters=mc_iters, n_jobs=n_jobs)
+    output_path = f"{output_dir}/{target_short_name}"
+
+    feature_lists = get_feature_lists(df)
 
-    only_substantiated_complaint_predictions = train_model(
+    checkpoint_names = {
+        "phat": "all_features",
+        "phat__only_sus_complaints": "only_sus_complaints",
+        "phat__only_complaints": "only_complaints",
+    }
+    checkpoint_dirs = {
+        pred_col: f"{output_path}/checkpoints/{model_type}/{name}" if checkpoint else None
+        for pred_col, name in checkpoint_names.items()
+    }
+    search_cache_dir = f"{output_dir}/search_cache" if search_cache else None
+
+    print("training on", target)
+    telemetry = []
+    all_preds = train_model_feature_sets(
         df,
         target=target,
-        feature_list=get_substantiated_complaint_features(df),
+        feature_lists=feature_lists,
         mc_iters=mc_iters,
         n_jobs=n_jobs,
-    )
-    only_substantiated_complaint_predictions.rename(
-        columns={"phat": "phat__only_sus_complaints"}, inplace=True
+        model_type=model_type,
+        checkpoint_dirs=checkpoint_dirs,
+        search_cache_dir=search_cache_dir,
+        narrow_search=narrow_search,
+        prune_features=prune_features,
+        telemetry=telemetry,
     )
 
-    only_complaint_predictions = train_model(
-        df, target=target, feature_list=get_all_complaint_cols(df), mc_iters=mc_iters, n_jobs=n_jobs
+    # The predictions are aligned with df, so no merge on tax_id/observation_date is needed
+    df_w_preds = pd.concat([df, all_preds], axis=1)
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    df_w_preds = apply_dtype_policy(df_w_preds)
+    write_year_partitioned_parquet(
+        df_w_preds, f"{output_path}/observations_with_predictions.parquet"
     )
-    only_complaint_predictions.rename(columns={"phat": "phat__only_complaints"}, inplace=True)
 
-    df_w_preds = pd.merge(
-        df,
-        all_feature_predictions,
-        how="inner",
-        left_on=["tax_id", "observation_date"],
-        right_on=["tax_id", "observation_date"],
-    )
-    df_w_preds = pd.merge(
-        df_w_preds,
-        only_substantiated_complaint_predictions,
-        how="inner",
-        left_on=["tax_id", "observation_date"],
-        right_on=["tax_id", "observation_date"],
-    )
-    df_w_preds = pd.merge(
-        df_w_preds,
-        only_complaint_predictions,
-        how="inner",
-        left_on=["tax_id", "observation_date"],
-        right_on=["tax_id", "observation_date"],
+    # Folds loaded from checkpoints were not trained in this run and have no telemetry
+    if len(telemetry) > 0:
+        telemetry = pd.concat(telemetry, ignore_index=True)
+        telemetry.to_parquet(f"{output_path}/training_telemetry.parquet", index=False)
+        print_slowest_configurations(telemetry)
+
+    if save_models:
+        for pred_col, feature_list in feature_lists.items():
+            fit_and_save_final_model(
+                df,
+                target,
+                feature_list,
+                pred_col,
+                f"{output_path}/models",
+                n_jobs=n_jobs,
+                model_type=model_type,
+                prune_features=prune_features,
+            )
+
+
+def backtest_and_write_predictions(
+    df,
+    target,
+    target_short_name,
+    output_dir="output",
+    n_jobs=1,
+    model_type="HistGBM_prebinned",
+    gap_years=0,
+):
+
+    """
+        Writes the backtest predictions of every feature set in the same schema as
+        train_model_and_write_predictions, under output/<target>/backtest. Only the years that
+        were predicted are kept.
+    """
+    output_path = f"{output_dir}/{target_short_name}/backtest"
+
+    print("backtesting", target)
+    all_preds = pd.DataFrame(
+        {
+            pred_col: backtest_model(
+                df, target, feature_list, n_jobs=n_jobs, model_type=model_type, gap_years=gap_years
+            )
+            for pred_col, feature_list in get_feature_lists(df).items()
+        }
     )
 
-    output_path = f"{output_dir}/{target_short_name}"
+    df_w_preds = pd.concat([df, all_preds], axis=1)
+    df_w_preds = df_w_preds[df_w_preds["phat"].notnull()]
 
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    df_w_preds.to_parquet(f"{output_path}/observations_with_predictions.parquet")
+    df_w_preds = apply_dtype_policy(df_w_preds)
+    write_year_partitioned_parquet(
+        df_w_preds, f"{output_path}/observations_with_predictions.parquet"
+    )
 
 
 if __name__ == "__main__":
@@ -166,52 +763,163 @@ if __name__ == "__main__":
         "--n_jobs", type=int, default=5, help="number of concurrently running workers (default: 5)"
     )
 
-    # Parse the arguments
-    args = parser.parse_args()
+    parser.add_argument(
+        "--model_type",
+        choices=list(MODEL_SPECS),
+        default=None,
+        help=f"model to search over, one of ml_utils.MODEL_SPECS (default: {DEFAULT_MODEL_TYPE}, "
+        f"or HistGBM_prebinned with --backtest)",
+    )
 
-    # Get the argument values
-    mc_iters = args.mc_iters
-    n_jobs = args.n_jobs
-    print(f"the specified number of jobs is {n_jobs}")
-    print(f"the specified number of iterations is {mc_iters}")
+    parser.add_argument(
+        "--prebin", action="store_true", help="same as --model_type HistGBM_prebinned"
+    )
 
-    main_table = pd.read_parquet(
-        "../create_observations_main_table/output/observation_table.parquet"
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="save each fold's predictions as it finishes and skip folds that were already saved",
     )
 
-    features = pd.read_parquet("../create_features_and_outcomes/output/features.parquet")
-    features.set_index(["tax_id", "observation_date"], inplace=True)
-    outcomes = pd.read_parquet("../create_features_and_outcomes/output/outcomes.parquet")
-    outcomes.set_index(["tax_id", "observation_date"], inplace=True)
+    parser.add_argument(
+        "--search_cache",
+        action="store_true",
+        help="reuse grid search results from earlier runs on identical training data",
+    )
 
-    main_table = pd.merge(
-        main_table, features, how="left", left_on=["tax_id", "observation_date"], right_index=True
+    parser.add_argument(
+        "--narrow_search",
+        action="store_true",
+        help="when the search cache misses, only search around the previous best parameters",
     )
 
-    main_table = pd.merge(
-        main_table, outcomes, how="left", left_on=["tax_id", "observation_date"], right_index=True
+    parser.add_argument(
+        "--save_models",
+        action="store_true",
+        help="also fit each model on all observations and save it under output/<target>/models",
+    )
+
+    parser.add_argument(
+        "--prune_features",
+        action="store_true",
+        help="leave out the columns that are constant or duplicated in each training split",
     )
 
-    active_officer_df = limit_observations_to_active_officers(main_table)
+    parser.add_argument(
+        "--save_observations",
+        action="store_true",
+        help="write the active officer observations to output/ for train_streaming.py",
+    )
+
+    parser.add_argument(
+        "--backtest",
+        action="store_true",
+        help="instead of cross-validation, train on earlier years and predict each following year",
+    )
+
+    parser.add_argument(
+        "--gap_years",
+        type=int,
+        default=0,
+        help="with --backtest, years left out between the training window and the predicted year",
+    )
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Get the argument values
+    mc_iters = args.mc_iters
+    n_jobs = args.n_jobs
+    model_type = args.model_type
+    if args.prebin:
+        model_type = "HistGBM_prebinned"
+    elif model_type is None:
+        model_type = "HistGBM_prebinned" if args.backtest else DEFAULT_MODEL_TYPE
+    print(f"the specified model type is {model_type}")
+    print(f"the specified number of jobs is {n_jobs}")
+    print(f"the specified number of iterations is {mc_iters}")
+    if args.backtest:
+        # Fail before loading the data if the model type cannot be continued year by year
+        get_warm_start_iter_param(model_type)
 
     PREDICTION_START = datetime(2014, 12, 31)
     PREDICTION_END = datetime(2019, 1, 2)
-    active_officer_df = active_officer_df[
-        active_officer_df.observation_date.between(PREDICTION_START, PREDICTION_END)
-    ].reset_index()
-
-    train_model_and_write_predictions(
-        active_officer_df,
-        "future_two_years.complaints.disposition_substantiated",
-        "sustained_complaints",
-        mc_iters=mc_iters,
-        n_jobs=n_jobs,
-    )
 
-    train_model_and_write_predictions(
-        active_officer_df,
-        "future_two_years.lawsuits.high_payout_suit",
-        "expensive_lawsuit",
-        mc_iters=mc_iters,
-        n_jobs=n_jobs,
+    main_table = pd.read_parquet(
+        "../create_observations_main_table/output/observation_table.parquet"
+    )
+    career_dates = pd.read_parquet("../create_career_start_end_dates/output/career_dates.parquet")
+    # The "index" column numbers the active observations of the whole observation table, like
+    # the reset_index() of the active officer table before it was limited to the prediction window
+    in_window = main_table.observation_date.between(PREDICTION_START, PREDICTION_END).values
+    active_positions, _ = find_active_observations(main_table, career_dates)
+    active_index = np.flatnonzero(in_window[active_positions])
+    main_table = main_table[in_window]
+
+    # Only the partitions of the prediction window are read. apply_dtype_policy is a no-op for
+    # files written with it and compacts older ones.
+    features = read_year_partitioned_parquet(
+        "../create_features_and_outcomes/output/features.parquet",
+        start_year=PREDICTION_START.year,
+        end_year=PREDICTION_END.year,
+    )
+    features = apply_dtype_policy(features)
+    outcomes = read_year_partitioned_parquet(
+        "../create_features_and_outcomes/output/outcomes.parquet",
+        start_year=PREDICTION_START.year,
+        end_year=PREDICTION_END.year,
     )
+    outcomes = apply_dtype_policy(outcomes)
+
+    active_officer_df = assemble_active_officer_table(main_table, features, outcomes, career_dates)
+    del features, outcomes
+    active_officer_df.insert(0, "index", active_index)
+
+    if args.save_observations:
+        if not os.path.exists("output"):
+            os.makedirs("output")
+        active_officer_df.to_parquet(
+            "output/active_officer_observations.parquet", row_group_size=100000
+        )
+
+    if args.backtest:
+        for target, target_short_name in [
+            ("future_two_years.complaints.disposition_substantiated", "sustained_complaints"),
+            ("future_two_years.lawsuits.high_payout_suit", "expensive_lawsuit"),
+        ]:
+            backtest_and_write_predictions(
+                active_officer_df,
+                target,
+                target_short_name,
+                n_jobs=n_jobs,
+                model_type=model_type,
+                gap_years=args.gap_years,
+            )
+    else:
+        train_model_and_write_predictions(
+            active_officer_df,
+            "future_two_years.complaints.disposition_substantiated",
+            "sustained_complaints",
+            mc_iters=mc_iters,
+            n_jobs=n_jobs,
+            model_type=model_type,
+            checkpoint=args.checkpoint,
+            search_cache=args.search_cache,
+            narrow_search=args.narrow_search,
+            save_models=args.save_models,
+            prune_features=args.prune_features,
+        )
+
+        train_model_and_write_predictions(
+            active_officer_df,
+            "future_two_years.lawsuits.high_payout_suit",
+            "expensive_lawsuit",
+            mc_iters=mc_iters,
+            n_jobs=n_jobs,
+            model_type=model_type,
+            checkpoint=args.checkpoint,
+            search_cache=args.search_cache,
+            narrow_search=args.narrow_search,
+            save_models=args.save_models,
+            prune_features=args.prune_features,
+        )
@@ -0,0 +1,212 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sklearn.linear_model import SGDClassifier
+from sklearn.metrics import log_loss
+from sklearn.model_selection import ParameterGrid
+from sklearn.pipeline import Pipeline
+
+from estimators import StreamingStandardizer
+from train_models import get_feature_lists
+
+ID_COLS = ["tax_id", "observation_date"]
+
+# Mirrors the elastic net grid of the `logistic` model type. SGD regularizes with alpha, which
+# plays the role of 1 / (C * n_observations).
+SGD_PARAM_GRID = {"l1_ratio": [0.1, 0.5, 0.9], "alpha": [1e-5, 1e-4, 1e-3, 1e-2, 1e-1]}
+
+
+def iter_row_groups(observations_file, columns, random_state=None):
+
+    """
+        Yields one row group of the parquet file at a time as a DataFrame. If random_state is
+        given, the row groups and the rows within them come in a shuffled order.
+    """
+    row_groups = np.arange(observations_file.num_row_groups)
+    if random_state is not None:
+        random_state.shuffle(row_groups)
+
+    for row_group in row_groups:
+        chunk = observations_file.read_row_group(row_group, columns=columns).to_pandas()
+        if random_state is not None:
+            chunk = chunk.iloc[random_state.permutation(len(chunk))]
+        yield chunk
+
+
+def get_cv_groups(tax_ids, iteration, n_groups=3):
+
+    """
+        Assigns every officer to one of n_groups folds by hashing the tax_id with the iteration,
+        so the folds are the same in every pass without holding a list of all officers
+    """
+    keys = pd.DataFrame({"tax_id": np.asarray(tax_ids), "iteration": iteration})
+    return (pd.util.hash_pandas_object(keys, index=False).values % n_groups).astype(int)
+
+
+def fit_streaming_models(
+    observations_path, target, feature_lists, mc_iters=1, n_epochs=5, random_state=0
+):
+
+    """
+        Trains elastic net SGD logistic regressions for every feature set, iteration and fold
+        while only holding one row group in memory at a time.
+
+        The first pass fits a StreamingStandardizer per model on its training rows. Every epoch
+        then passes over the row groups in a shuffled order and calls partial_fit on every
+        candidate of SGD_PARAM_GRID. During the first epoch each chunk is scored before it is
+        trained on (progressive validation), and the candidate with the lowest log loss is kept.
+
+        Returns {(pred_col, iteration, cv_group): Pipeline}
+    """
+    observations_file = pq.ParquetFile(observations_path)
+    feature_cols = sorted(set(c for feature_list in feature_lists.values() for c in feature_list))
+    columns = ID_COLS + feature_cols + [target]
+    rng = np.random.RandomState(random_state)
+
+    model_keys = [
+        (pred_col, i, j) for pred_col in feature_lists for i in range(mc_iters) for j in range(3)
+    ]
+    preprocs = {key: StreamingStandardizer() for key in model_keys}
+    candidates = {
+        key: [
+            SGDClassifier(
+                loss="log",
+                penalty="elasticnet",
+                learning_rate="invscaling",
+                eta0=0.1,
+                random_state=random_state,
+                **params,
+            )
+            for params in ParameterGrid(SGD_PARAM_GRID)
+        ]
+        for key in model_keys
+    }
+    progressive_loss = {key: np.zeros(len(candidates[key])) for key in model_keys}
+
+    def iter_training_rows(shuffle):
+        for chunk in iter_row_groups(observations_file, columns, rng if shuffle else None):
+            y = ((chunk[target] >= 1) * 1).values
+            cv_groups = {i: get_cv_groups(chunk["tax_id"], i) for i in range(mc_iters)}
+            for pred_col, i, j in model_keys:
+                train_mask = cv_groups[i] != j
+                X_train = chunk[feature_lists[pred_col]].values[train_mask]
+                yield (pred_col, i, j), X_train, y[train_mask]
+
+    print("computing standardization statistics")
+    for key, X_train, _ in iter_training_rows(shuffle=False):
+        preprocs[key].partial_fit(X_train)
+
+    for epoch in range(n_epochs):
+        print(f"epoch {epoch}")
+        for key, X_train, y_train in iter_training_rows(shuffle=True):
+            X_train = preprocs[key].transform(X_train)
+            for c, clf in enumerate(candidates[key]):
+                if epoch == 0 and hasattr(clf, "coef_"):
+                    proba = clf.predict_proba(X_train)[:, 1]
+                    progressive_loss[key][c] += log_loss(
+                        y_train, proba, labels=[0, 1], normalize=False
+                    )
+                clf.partial_fit(X_train, y_train, classes=[0, 1])
+
+    models = {}
+    for key in model_keys:
+        best_clf = candidates[key][int(np.argmin(progressive_loss[key]))]
+        print(key, "best params", {p: best_clf.get_params()[p] for p in SGD_PARAM_GRID})
+        models[key] = Pipeline([("preproc", preprocs[key]), ("clf", best_clf)])
+
+    return models
+
+
+def write_streaming_predictions(observations_path, models, feature_lists, mc_iters, output_path):
+
+    """
+        Passes over the observations once more and writes every row with the out of fold
+        predictions for every feature set, averaged over the iterations
+    """
+    observations_file = pq.ParquetFile(observations_path)
+
+    writer = None
+    for chunk in iter_row_groups(observations_file, None):
+        cv_groups = {i: get_cv_groups(chunk["tax_id"], i) for i in range(mc_iters)}
+        for pred_col, feature_list in feature_lists.items():
+            phat = np.zeros(len(chunk))
+            for i in range(mc_iters):
+                for j in range(3):
+                    test_mask = cv_groups[i] == j
+                    if test_mask.any():
+                        X_test = chunk[feature_list].values[test_mask]
+                        phat[test_mask] += models[(pred_col, i, j)].predict_proba(X_test)[:, 1]
+            chunk[pred_col] = phat / mc_iters
+
+        chunk_table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(output_path, chunk_table.schema)
+        writer.write_table(chunk_table)
+
+    if writer is not None:
+        writer.close()
+
+
+def train_streaming_and_write_predictions(
+    observations_path,
+    target,
+    target_short_name,
+    output_dir="output/streaming",
+    mc_iters=1,
+    n_epochs=5,
+):
+
+    schema_df = pd.DataFrame(columns=pq.ParquetFile(observations_path).schema_arrow.names)
+    feature_lists = get_feature_lists(schema_df)
+
+    print("training on", target)
+    models = fit_streaming_models(
+        observations_path, target, feature_lists, mc_iters=mc_iters, n_epochs=n_epochs
+    )
+
+    output_path = f"{output_dir}/{target_short_name}"
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    write_streaming_predictions(
+        observations_path,
+        models,
+        feature_lists,
+        mc_iters,
+        f"{output_path}/observations_with_predictions.parquet",
+    )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--observations",
+        default="output/active_officer_observations.parquet",
+        help="parquet with the ids, features and outcomes of the active officer observations",
+    )
+    parser.add_argument(
+        "--mc_iters", type=int, default=5, help="number of Monte Carlo iterations (default: 5)"
+    )
+    parser.add_argument(
+        "--n_epochs", type=int, default=5, help="passes over the data per model (default: 5)"
+    )
+    parser.add_argument("--output_dir", default="output/streaming")
+
+    args = parser.parse_args()
+
+    for target, target_short_name in [
+        ("future_two_years.complaints.disposition_substantiated", "sustained_complaints"),
+        ("future_two_years.lawsuits.high_payout_suit", "expensive_lawsuit"),
+    ]:
+        train_streaming_and_write_predictions(
+            args.observations,
+            target,
+            target_short_name,
+            output_dir=args.output_dir,
+            mc_iters=args.mc_iters,
+            n_epochs=args.n_epochs,
+        )
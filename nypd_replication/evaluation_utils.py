@@ -1,8 +1,27 @@
 import pandas as pd
 import numpy as np
+import warnings
+from collections import OrderedDict
+from itertools import combinations
+from joblib import Parallel, delayed
+import pyarrow.dataset as ds
 from sklearn.metrics import roc_auc_score
 
 RBC_SAMPLE_RANDOM_STATE = 42
+BOOTSTRAP_RANDOM_STATE = 42
+BOOTSTRAP_CHUNK_SIZE = 100
+REPORT_SPEC_FIELDS = ["pred_col", "outcome", "threshold", "indicator", "ties"]
+ROSTER_PATH = "data_processing/clean_roster/output/clean_roster.parquet"
+QUANTILE_SKETCH_SIZE = 2 ** 14
+STREAMING_BATCH_SIZE = 100000
+STREAMING_BAND_SIZE = 2 ** 20
+FADO_TYPES = [
+    "FADO_abuse_of_authority",
+    "FADO_discourtesy",
+    "FADO_force",
+    "FADO_offensive_language",
+    "FADO_untruthful_statement",
+]
 
 def calc_auc(preds_w_outcomes, pred_col, outcome):
     '''
@@ -45,10 +64,10 @@ def calc_base_rate(y, outcome, indicator=True):
         base_rate: (float) proportion of officers with outcome in outcome period
     '''
     if indicator:
-        base_rates = y.groupby("pred_year").apply(lambda x: x[outcome].clip(upper=1).mean()).to_frame()
+        outcomes = y[outcome].clip(upper=1)
     else:
-        base_rates = y.groupby("pred_year").apply(lambda x: x[outcome].mean()).to_frame()
-    base_rates.rename(columns={0: "Base Rate"}, inplace=True)
+        outcomes = y[outcome]
+    base_rates = outcomes.groupby(y["pred_year"]).mean().to_frame("Base Rate")
     base_rate = base_rates["Base Rate"].mean()
     
     return base_rate
@@ -73,6 +92,32 @@ def get_flags(preds, pred_col, threshold):
     return preds_w_flags
 
 
+def get_flagged_sums_across_years(preds_w_flags, value_col):
+    '''
+    Sums a column over the flagged officers of each period/year
+
+    Parameters:
+        preds_w_flags: (df) with the "flagged" column added by get_flags
+        value_col: (str) name of column to sum
+    Returns:
+        (series) with the period start date as the index and the sum over the
+        flagged officers as the value. Boolean and integer columns give int64
+        sums, other columns float64 sums that skip NaN
+    '''
+    year_codes, years = pd.factorize(preds_w_flags["pred_year"], sort=True)
+    flagged = preds_w_flags["flagged"].to_numpy(dtype=bool)
+    values = preds_w_flags[value_col].to_numpy()
+    if values.dtype.kind in "biu":
+        flagged_sums = np.bincount(year_codes[flagged], weights=values[flagged],
+                                   minlength=len(years)).astype(np.int64)
+    else:
+        values = values.astype(np.float64)
+        flagged = flagged & ~np.isnan(values)
+        flagged_sums = np.bincount(year_codes[flagged], weights=values[flagged],
+                                   minlength=len(years))
+    return pd.Series(flagged_sums, index=pd.Index(years, name="pred_year"))
+
+
 def average_stat_across_periods(stat_df, stat_col_name):
     '''
     Calculates the average of some eval statistic accross all years
@@ -157,8 +202,8 @@ def calc_recall_across_years(preds_w_outcomes, pred_col, outcome, threshold, ind
         preds_w_flags["outcome"] = preds_w_flags[outcome] >= 1
     else:
         preds_w_flags["outcome"] = preds_w_flags[outcome].copy()
-    recall_across_years = preds_w_flags.groupby('pred_year').apply(lambda x: x[x["flagged"] == True]["outcome"].sum() / x["outcome"].sum()).to_frame()
-    recall_across_years.rename(columns={0: "recall"}, inplace=True)
+    recall_across_years = (get_flagged_sums_across_years(preds_w_flags, "outcome")
+                           / preds_w_flags.groupby("pred_year")["outcome"].sum()).to_frame("recall")
     
     return recall_across_years
 
@@ -202,8 +247,8 @@ def calc_num_true_positives_across_years(preds_w_outcomes, pred_col, outcome, th
     '''
     preds_w_flags = get_flags(preds_w_outcomes, pred_col, threshold)
     preds_w_flags["indicator_outcome"] = preds_w_flags[outcome] >= 1
-    true_positives_across_years = preds_w_flags.groupby('pred_year').apply(lambda x: x[x["flagged"] == True]["indicator_outcome"].sum()).to_frame()
-    true_positives_across_years.rename(columns={0: "true_positives"}, inplace=True)
+    true_positives_across_years = get_flagged_sums_across_years(
+        preds_w_flags, "indicator_outcome").to_frame("true_positives")
     
     return true_positives_across_years
 
@@ -227,6 +272,424 @@ def calc_num_true_postives(preds_w_outcomes, pred_col, outcome, threshold):
     return true_positives
 
 
+def get_percentile_ranks_sorted(sorted_scores):
+    '''
+    Computes rank(pct=True) with the default "average" tie method for scores
+    that are already sorted in ascending order
+
+    Parameters:
+        sorted_scores: (array) of scores in ascending order, without NaN
+    Returns:
+        (array) the percentile rank of every score, in the same order
+    '''
+    n = len(sorted_scores)
+    n_below = np.searchsorted(sorted_scores, sorted_scores, side="left")
+    n_below_or_tied = np.searchsorted(sorted_scores, sorted_scores, side="right")
+    return ((n_below + 1 + n_below_or_tied) / 2) / n
+
+
+def get_expected_flagged_sums(sorted_scores, cum_values, n_flagged):
+    '''
+    Calculates the expected sum of a statistic over the n_flagged highest
+    scores when ties are broken uniformly at random. Every tie-block above the
+    cutoff is flagged whole, and the flagged share of the block at the cutoff
+    is flagged in expectation.
+
+    Parameters:
+        sorted_scores: (array) of scores in descending order
+        cum_values: (array) cumulative sums of the statistic in the same
+                    order, starting with 0
+        n_flagged: (array) numbers of flagged officers
+    Returns:
+        (array) the expected sum for every number of flagged officers
+    '''
+    if len(sorted_scores) == 0:
+        return np.zeros(len(n_flagged))
+    ascending_scores = sorted_scores[::-1]
+    cutoff_scores = sorted_scores[np.maximum(n_flagged - 1, 0)]
+    n_scores = len(sorted_scores)
+    block_start = n_scores - np.searchsorted(ascending_scores, cutoff_scores, side="right")
+    block_end = n_scores - np.searchsorted(ascending_scores, cutoff_scores, side="left")
+    block_sums = cum_values[block_end] - cum_values[block_start]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected_sums = cum_values[block_start] + (n_flagged - block_start) * block_sums / (
+            block_end - block_start)
+    return np.where(n_flagged == 0, 0, expected_sums)
+
+
+def get_year_threshold(threshold, pred_year):
+    '''
+    Gets the threshold of a year
+
+    Parameters:
+        threshold: (float) or a dict or series with the threshold of each
+                   pred_year
+        pred_year: year of the predictions
+    Returns:
+        threshold: (float)
+    '''
+    if isinstance(threshold, (dict, pd.Series)):
+        return threshold[pred_year]
+    return threshold
+
+
+class Evaluator:
+    '''
+    Calculates the eval statistics of a predictions frame from a cache of the
+    sorted scores and percentile ranks of every (score column, pred_year), so
+    that all the metrics, outcomes and thresholds of a score column are served
+    from a single sort instead of a get_flags call each. The statistics are
+    the same as calc_precision, calc_recall and calc_num_true_postives (or
+    with ties="random", calc_precision_rbc and
+    calc_recall_and_num_true_positives_rbc).
+    The cache is not invalidated when the frame is modified, so create a new
+    Evaluator after changing the scores.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores and outcomes
+        max_cached_ranks: (int) maximum number of (score column, pred_year)
+                          entries kept in the cache. The least recently used
+                          one is evicted first
+    '''
+
+    def __init__(self, preds_w_outcomes, max_cached_ranks=128):
+        self.preds_w_outcomes = preds_w_outcomes
+        self.max_cached_ranks = max_cached_ranks
+        self.year_indices = preds_w_outcomes.groupby("pred_year").indices
+        self._ranks = OrderedDict()
+
+    def get_sorted_ranks(self, pred_col, pred_year):
+        '''
+        Sorts the scores of a year, or gets them from the cache
+
+        Parameters:
+            pred_col: (str) name of column with risk scores
+            pred_year: year of the predictions
+        Returns:
+            order: (array) positions of the officers with a score, by
+                   descending score
+            sorted_scores: (array) their scores, in the same order
+            sorted_pct: (array) their percentile ranks, in ascending order
+        '''
+        key = (pred_col, pred_year)
+        if key in self._ranks:
+            self._ranks.move_to_end(key)
+            return self._ranks[key]
+
+        year_ix = self.year_indices[pred_year]
+        scores = self.preds_w_outcomes[pred_col].values
+        # Officers without a score are never flagged but count towards the recall
+        scored_ix = year_ix[~np.isnan(scores[year_ix])]
+        order = scored_ix[np.argsort(scores[scored_ix], kind="stable")[::-1]]
+        sorted_scores = scores[order]
+        ranks = (order, sorted_scores, get_percentile_ranks_sorted(sorted_scores[::-1]))
+
+        self._ranks[key] = ranks
+        if len(self._ranks) > self.max_cached_ranks:
+            self._ranks.popitem(last=False)
+        return ranks
+
+    def get_n_flagged(self, pred_col, pred_year, thresholds, ties="average"):
+        '''
+        Counts the officers of a year flagged at each threshold
+
+        Parameters:
+            pred_col: (str) name of column with risk scores
+            pred_year: year of the predictions
+            thresholds: (float or array) minimum percentiles of risk score at
+                        which officers will be flagged. Range [0, 1]
+            ties: (str) "average" like get_flags, or "random" like
+                  get_flags_rbc, which flags exactly (1 - threshold)% of the
+                  officers
+        Returns:
+            order: (array) see get_sorted_ranks
+            sorted_scores: (array) see get_sorted_ranks
+            n_flagged: (int or array) number of flagged officers, the first
+                       ones of order
+        '''
+        order, sorted_scores, sorted_pct = self.get_sorted_ranks(pred_col, pred_year)
+        n_scored = len(order)
+        if ties == "random":
+            # rank(pct=True, method="first") gives every officer a distinct rank
+            sorted_pct = np.arange(1, n_scored + 1) / n_scored
+        n_flagged = n_scored - np.searchsorted(sorted_pct, thresholds, side="left")
+        return order, sorted_scores, n_flagged
+
+    def get_flag_weights(self, pred_col, threshold, ties="average"):
+        '''
+        Determines which officers are flagged, like get_flags
+
+        Parameters:
+            pred_col: (str) name of column with risk scores
+            threshold: (float) minimum percentile of risk score at which
+                        officers will be flagged. Range [0, 1]. Can also be a
+                        dict or series with the threshold of each pred_year
+            ties: (str) "average" like get_flags, or "random" like
+                  get_flags_rbc
+        Returns:
+            (array) aligned with the rows of the frame, 1 for the flagged
+            officers and 0 otherwise. With ties="random", the officers tied at
+            the cutoff get their probability of being flagged
+        '''
+        if ties not in ["average", "random"]:
+            raise ValueError(f"ties must be 'average' or 'random', got {ties!r}")
+        flag_weights = np.zeros(len(self.preds_w_outcomes))
+        for pred_year in self.year_indices:
+            order, sorted_scores, n_flagged = self.get_n_flagged(
+                pred_col, pred_year, get_year_threshold(threshold, pred_year), ties)
+            flag_weights[order[:n_flagged]] = 1
+            if ties == "random" and n_flagged > 0:
+                cutoff_score = sorted_scores[n_flagged - 1]
+                block = order[sorted_scores == cutoff_score]
+                n_above = np.sum(sorted_scores > cutoff_score)
+                flag_weights[block] = (n_flagged - n_above) / len(block)
+        return flag_weights
+
+    def threshold_sweep_across_years(self, pred_col, outcome, thresholds, payout_col=None,
+                                     indicator=True, ties="average"):
+        '''
+        See calc_threshold_sweep_across_years
+        '''
+        if ties not in ["average", "random"]:
+            raise ValueError(f"ties must be 'average' or 'random', got {ties!r}")
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        outcomes = self.preds_w_outcomes[outcome].values
+        stat_cols = {
+            "outcome": (outcomes >= 1) if indicator else outcomes,
+            "true_positives": outcomes >= 1,
+        }
+        if payout_col is not None:
+            stat_cols["payout"] = self.preds_w_outcomes[payout_col].values
+        stat_cols = {name: values.astype(np.float64) for name, values in stat_cols.items()}
+
+        sweeps = []
+        for pred_year, year_ix in self.year_indices.items():
+            order, sorted_scores, n_flagged = self.get_n_flagged(pred_col, pred_year, thresholds,
+                                                                 ties)
+
+            year_sweep = {"pred_year": pred_year, "threshold": thresholds, "n_flagged": n_flagged}
+            flagged_sums = {}
+            for name, values in stat_cols.items():
+                sorted_values = values[order]
+                cum_values = np.concatenate([[0], np.cumsum(np.nan_to_num(sorted_values))])
+                cum_known = np.concatenate([[0], np.cumsum(~np.isnan(sorted_values))])
+                if ties == "average":
+                    flagged_sums[name] = (cum_values[n_flagged], cum_known[n_flagged],
+                                          np.nansum(values[year_ix]))
+                else:
+                    flagged_sums[name] = (
+                        get_expected_flagged_sums(sorted_scores, cum_values, n_flagged),
+                        get_expected_flagged_sums(sorted_scores, cum_known, n_flagged),
+                        np.nansum(values[year_ix]))
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                flagged_outcome, n_known, total_outcome = flagged_sums["outcome"]
+                year_sweep["precision"] = flagged_outcome / n_known
+                year_sweep["recall"] = flagged_outcome / total_outcome
+                year_sweep["true_positives"] = flagged_sums["true_positives"][0]
+                if payout_col is not None:
+                    flagged_payout, _, total_payout = flagged_sums["payout"]
+                    year_sweep["payout_recall"] = flagged_payout / total_payout
+
+            sweeps.append(pd.DataFrame(year_sweep))
+
+        return pd.concat(sweeps, ignore_index=True)
+
+    def threshold_sweep(self, pred_col, outcome, thresholds, payout_col=None, indicator=True,
+                        ties="average"):
+        '''
+        See calc_threshold_sweep
+        '''
+        sweep_across_years = self.threshold_sweep_across_years(
+            pred_col, outcome, thresholds, payout_col=payout_col, indicator=indicator, ties=ties)
+        stat_cols = [c for c in ["precision", "recall", "true_positives", "payout_recall"]
+                     if c in sweep_across_years.columns]
+        # Series.mean per threshold, as in average_stat_across_periods
+        sweep = sweep_across_years.groupby("threshold", sort=False)[stat_cols].agg(
+            lambda stat: average_stat_across_periods(stat.to_frame(), stat.name))
+        return sweep.reset_index()
+
+    def _stat_across_years(self, stat_col, pred_col, outcome, threshold, indicator, ties):
+        sweep = self.threshold_sweep_across_years(pred_col, outcome, [threshold],
+                                                  indicator=indicator, ties=ties)
+        if stat_col == "precision":
+            # Like calc_precision_across_years, years without flagged officers are left out
+            sweep = sweep[sweep["n_flagged"] > 0]
+        return sweep.set_index("pred_year")[[stat_col]]
+
+    def precision_across_years(self, pred_col, outcome, threshold, indicator=True,
+                               ties="average"):
+        '''
+        See calc_precision_across_years. ties="random" gives the expected
+        precision of calc_precision_rbc
+        '''
+        return self._stat_across_years("precision", pred_col, outcome, threshold, indicator,
+                                       ties)
+
+    def precision(self, pred_col, outcome, threshold, indicator=True, ties="average"):
+        '''
+        See calc_precision
+        '''
+        return average_stat_across_periods(
+            self.precision_across_years(pred_col, outcome, threshold, indicator, ties),
+            "precision")
+
+    def recall_across_years(self, pred_col, outcome, threshold, indicator=True, ties="average"):
+        '''
+        See calc_recall_across_years
+        '''
+        return self._stat_across_years("recall", pred_col, outcome, threshold, indicator, ties)
+
+    def recall(self, pred_col, outcome, threshold, indicator=True, ties="average"):
+        '''
+        See calc_recall
+        '''
+        return average_stat_across_periods(
+            self.recall_across_years(pred_col, outcome, threshold, indicator, ties), "recall")
+
+    def num_true_positives_across_years(self, pred_col, outcome, threshold, ties="average"):
+        '''
+        See calc_num_true_positives_across_years
+        '''
+        return self._stat_across_years("true_positives", pred_col, outcome, threshold, True,
+                                       ties)
+
+    def num_true_positives(self, pred_col, outcome, threshold, ties="average"):
+        '''
+        See calc_num_true_postives
+        '''
+        return average_stat_across_periods(
+            self.num_true_positives_across_years(pred_col, outcome, threshold, ties),
+            "true_positives")
+
+
+def calc_threshold_sweep_across_years(preds_w_outcomes, pred_col, outcome, thresholds,
+                                      payout_col=None, indicator=True, ties="average"):
+    '''
+    Calculates the precision, recall and number of true positives of a model
+    at every threshold, for each period/year. The officers flagged at a
+    threshold are the same as with get_flags, but the scores of each year are
+    only sorted once: the flagged officers are then the top of the sorted
+    scores, and every statistic is read off cumulative sums of the outcomes.
+
+    With ties="random" the statistics are instead the exact expected values
+    when exactly (1 - threshold)% of officers are flagged and ties are broken
+    uniformly at random, as get_flags_rbc does for rank by complaints. This
+    is what the rbc functions converge to as n_iterations grows.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores and outcomes
+        pred_col: (str) name of column with risk scores produced by model
+                  of interest
+        outcome: (str) name of outcome
+        thresholds: (list) of minimum percentiles of risk score at which
+                    officers will be flagged. Range [0, 1]
+        payout_col: (str) optional name of a payout column. If given, the
+                    recall of the payouts (calc_recall with indicator=False)
+                    is added as "payout_recall"
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        ties: (str) "average" to flag officers by their average percentile
+              rank like get_flags, or "random" for the expected statistics
+              under random tie-breaking like get_flags_rbc
+    Returns:
+        (df) with one row per year and threshold, with the number of flagged
+        officers, precision, recall, true positives and optionally the payout
+        recall. Years where no officer is flagged have a NaN precision, like
+        the years that calc_precision_across_years leaves out.
+    '''
+    return Evaluator(preds_w_outcomes).threshold_sweep_across_years(
+        pred_col, outcome, thresholds, payout_col=payout_col, indicator=indicator, ties=ties)
+
+
+def calc_threshold_sweep(preds_w_outcomes, pred_col, outcome, thresholds, payout_col=None,
+                         indicator=True, ties="average"):
+    '''
+    Calculates the precision, recall and number of true positives of a model
+    at every threshold, averaged across years. The same as calling
+    calc_precision, calc_recall and calc_num_true_postives (and calc_recall
+    of payout_col with indicator=False) for every threshold.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores and outcomes
+        pred_col: (str) name of column with risk scores produced by model
+                  of interest
+        outcome: (str) name of outcome
+        thresholds: (list) of minimum percentiles of risk score at which
+                    officers will be flagged. Range [0, 1]
+        payout_col: (str) optional name of a payout column
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        ties: (str) "average" like get_flags, or "random" for the expected
+              statistics under random tie-breaking like get_flags_rbc
+    Returns:
+        (df) with one row per threshold and the precision, recall,
+        true_positives and optionally payout_recall columns
+    '''
+    return Evaluator(preds_w_outcomes).threshold_sweep(
+        pred_col, outcome, thresholds, payout_col=payout_col, indicator=indicator, ties=ties)
+
+
+def get_report_spec(spec):
+    '''
+    Fills in the defaults of a calc_report spec
+
+    Parameters:
+        spec: (dict or tuple) with the REPORT_SPEC_FIELDS, in that order if
+              it is a tuple. indicator defaults to True and ties to "average"
+    Returns:
+        (dict) with all of the REPORT_SPEC_FIELDS
+    '''
+    if not isinstance(spec, dict):
+        spec = dict(zip(REPORT_SPEC_FIELDS, spec))
+    return {"indicator": True, "ties": "average", **spec}
+
+
+def calc_report_for_column(preds_w_outcomes, pred_col, specs):
+    '''
+    Calculates the calc_report specs of a single score column, with one
+    threshold sweep per outcome, indicator and ties setting
+    '''
+    evaluator = Evaluator(preds_w_outcomes)
+    report = []
+    for (outcome, indicator, ties), sweep_specs in specs.groupby(["outcome", "indicator", "ties"]):
+        sweep = evaluator.threshold_sweep(pred_col, outcome, np.unique(sweep_specs["threshold"]),
+                                          indicator=indicator, ties=ties)
+        stats = sweep.set_index("threshold").loc[sweep_specs["threshold"]]
+        stats.index = sweep_specs.index
+        report.append(sweep_specs.join(stats))
+    return pd.concat(report)
+
+
+def calc_report(preds_w_outcomes, specs, n_jobs=1):
+    '''
+    Calculates the precision, recall and number of true positives for many
+    (score column, outcome, threshold, indicator) specs at once. The score
+    columns are evaluated in parallel, and each of them is only sorted once
+    per year whatever the number of specs that use it. The statistics are the
+    same as calc_precision, calc_recall and calc_num_true_postives, or with
+    ties="random" the exact rank by complaints ones.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores and outcomes
+        specs: (list) of dicts or tuples with the REPORT_SPEC_FIELDS, see
+               get_report_spec
+        n_jobs: (int) number of processes evaluating score columns
+    Returns:
+        (df) with one row per spec, in the same order, with the spec and its
+        precision, recall and true_positives
+    '''
+    specs = pd.DataFrame([get_report_spec(spec) for spec in specs], columns=REPORT_SPEC_FIELDS)
+    reports = Parallel(n_jobs=n_jobs)(
+        delayed(calc_report_for_column)(
+            # Only the columns used by a score column are sent to its process
+            preds_w_outcomes[list(dict.fromkeys(["pred_year", pred_col, *col_specs["outcome"]]))],
+            pred_col, col_specs)
+        for pred_col, col_specs in specs.groupby("pred_col"))
+    report = pd.concat(reports).sort_index()
+    return report[REPORT_SPEC_FIELDS + ["precision", "recall", "true_positives"]]
+
+
 def get_flags_rbc(preds, rbc_col, threshold, random_state):
     '''
     Determines which officers are flagged for Rank by Complaints.
@@ -300,8 +763,8 @@ def calc_recall_across_years_rbc(preds_w_outcomes, rbc_col, outcome, threshold,
         preds_w_flags["outcome"] = preds_w_flags[outcome] >= 1
     else:
         preds_w_flags["outcome"] = preds_w_flags[outcome].copy()
-    recall_across_years = preds_w_flags.groupby('pred_year').apply(lambda x: x[x["flagged"] == True]["outcome"].sum() / x["outcome"].sum()).to_frame()
-    recall_across_years.rename(columns={0: "recall"}, inplace=True)
+    recall_across_years = (get_flagged_sums_across_years(preds_w_flags, "outcome")
+                           / preds_w_flags.groupby("pred_year")["outcome"].sum()).to_frame("recall")
     
     return recall_across_years
 
@@ -324,20 +787,25 @@ def calc_num_true_positives_across_years_rbc(preds_w_outcomes, rbc_col, outcome,
     '''
     preds_w_flags = get_flags_rbc(preds_w_outcomes, rbc_col, threshold, random_state)
     preds_w_flags["indicator_outcome"] = preds_w_flags[outcome] >= 1
-    true_positives_across_years = preds_w_flags.groupby('pred_year').apply(lambda x: x[x["flagged"] == True]["indicator_outcome"].sum()).to_frame()
-    true_positives_across_years.rename(columns={0: "true_positives"}, inplace=True)
+    true_positives_across_years = get_flagged_sums_across_years(
+        preds_w_flags, "indicator_outcome").to_frame("true_positives")
     
     return true_positives_across_years
 
 
 def calc_precision_rbc(preds_w_outcomes, rbc_col, outcome, threshold,
-                       n_iterations=10, indicator=True):
+                       n_iterations=10, indicator=True, exact=True):
     '''
     Calculates precision for rank by complaints.
     Because there are ties between officers and we want to flag exactly
     (1-threshold)% of officers per year, we use a scheme where we randomly
     break ties between officers over many iterations and then average the eval 
     statistic across the iterations.
+    With exact=True (the default) the expected precision under random
+    tie-breaking is calculated directly, in one pass, which is what the
+    average converges to. The random tie-breaks of exact=False depend on the
+    row order of preds_w_outcomes, so they do not reproduce results computed
+    from predictions in another order.
 
     Parameters:
         preds_w_outcomes: (df) with the rank by complaints and outcome columns
@@ -348,9 +816,16 @@ def calc_precision_rbc(preds_w_outcomes, rbc_col, outcome, threshold,
         n_iterations: (int) number of iterations of calculating statistcs where
                       we are randomly breaking ties between officers
         indicator: (bool) True if we want to calculate the indicator precision
+        exact: (bool) True to calculate the expected precision exactly instead
+               of averaging n_iterations random tie-breaks
     Returns:
         precision: (float)
     '''
+    if exact:
+        sweep = calc_threshold_sweep(preds_w_outcomes, rbc_col, outcome, [threshold],
+                                     indicator=indicator, ties="random")
+        return sweep["precision"].iloc[0]
+
     random_state = RBC_SAMPLE_RANDOM_STATE
     precisions = []
     for i in range(n_iterations):
@@ -367,13 +842,16 @@ def calc_precision_rbc(preds_w_outcomes, rbc_col, outcome, threshold,
 
 
 def calc_recall_and_num_true_positives_rbc(preds_w_outcomes, rbc_col, outcome, threshold,
-                                           n_iterations=10, indicator=True):
+                                           n_iterations=10, indicator=True, exact=True):
     '''
     Calculates recall and number of true positives for rank by complaints.
     Because there are ties between officers and we want to flag exactly
     (1-threshold)% of officers per year, we use a scheme where we randomly
     break ties between officers over many iterations and then average the eval 
     statistic across the iterations.
+    With exact=True (the default) the expected recall and number of true
+    positives under random tie-breaking are calculated directly, in one pass,
+    as in calc_precision_rbc.
 
     Parameters:
         preds_w_outcomes: (df) with the rank by complaints and outcome columns
@@ -384,10 +862,17 @@ def calc_recall_and_num_true_positives_rbc(preds_w_outcomes, rbc_col, outcome, t
         n_iterations: (int) number of iterations of calculating statistcs where
                       we are randomly breaking ties between officers
         indicator: (bool) True if we want to calculate the indicator recall
+        exact: (bool) True to calculate the expected statistics exactly instead
+               of averaging n_iterations random tie-breaks
     Returns:
         recall: (float)
         true_positive: (int)
     '''
+    if exact:
+        sweep = calc_threshold_sweep(preds_w_outcomes, rbc_col, outcome, [threshold],
+                                     indicator=indicator, ties="random")
+        return sweep["recall"].iloc[0], sweep["true_positives"].iloc[0]
+
     random_state = RBC_SAMPLE_RANDOM_STATE
     recalls = []
     true_positives = []
@@ -407,3 +892,860 @@ def calc_recall_and_num_true_positives_rbc(preds_w_outcomes, rbc_col, outcome, t
     true_positive = np.mean(true_positives)
     
     return recall, true_positive
+
+
+def calc_rbc_tie_break_distribution(preds_w_outcomes, rbc_col, outcome, threshold,
+                                    n_iterations=1000, indicator=True,
+                                    random_state=RBC_SAMPLE_RANDOM_STATE, evaluator=None):
+    '''
+    Simulates n_iterations random tie-breaks for rank by complaints at once,
+    to get the distribution of the eval statistics rather than their expected
+    value (see calc_precision_rbc with exact=True).
+    Officers are sorted once per year. Only the tie-block at the cutoff is
+    affected by the tie-break, so a (n_iterations x block size) matrix of
+    random keys is drawn for it and, in every iteration, the officers of the
+    block with the smallest keys fill the remaining flagged places.
+
+    Parameters:
+        preds_w_outcomes: (df) with the rank by complaints and outcome columns
+        rbc_col: (str) name of rank by complaint column
+        outcome: (str) name of outcome
+        threshold: (float) minimum percentile of risk score at which 
+                    officers will be flagged. Range [0, 1]. Can also be a dict
+                    or series with the threshold of each pred_year
+        n_iterations: (int) number of random tie-breaks
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        random_state: (int) random seed for the tie-break keys
+        evaluator: (Evaluator) optional, to reuse its cached ranks
+    Returns:
+        (df) with one row per iteration and the precision, recall and number
+        of true positives averaged across years, like a single iteration of
+        calc_precision_rbc and calc_recall_and_num_true_positives_rbc
+    '''
+    if evaluator is None:
+        evaluator = Evaluator(preds_w_outcomes)
+    rng = np.random.RandomState(random_state)
+    outcomes = preds_w_outcomes[outcome].values
+    stat_cols = {
+        "outcome": (outcomes >= 1) if indicator else outcomes,
+        "true_positives": outcomes >= 1,
+    }
+    stat_cols = {name: values.astype(np.float64) for name, values in stat_cols.items()}
+
+    stats_across_years = {"precision": [], "recall": [], "true_positives": []}
+    for pred_year, year_ix in evaluator.year_indices.items():
+        order, sorted_scores, n_flagged = evaluator.get_n_flagged(
+            rbc_col, pred_year, get_year_threshold(threshold, pred_year), ties="random")
+
+        if n_flagged == 0:
+            block, block_start = order[:0], 0
+            block_flagged = np.zeros((n_iterations, 0), dtype=np.int64)
+        else:
+            block_start = np.sum(sorted_scores > sorted_scores[n_flagged - 1])
+            block_end = np.sum(sorted_scores >= sorted_scores[n_flagged - 1])
+            block = order[block_start:block_end]
+            n_block_flagged = n_flagged - block_start
+
+            keys = rng.random_sample((n_iterations, len(block)))
+            block_flagged = np.argpartition(keys, n_block_flagged - 1, axis=1)
+            block_flagged = block_flagged[:, :n_block_flagged]
+
+        # Officers above the tie-block are flagged in every iteration
+        flagged_sums = {}
+        for name, values in stat_cols.items():
+            flagged_sums[name] = (np.nansum(values[order[:block_start]])
+                                  + np.nansum(values[block][block_flagged], axis=1))
+        flagged_known = (np.sum(~np.isnan(stat_cols["outcome"][order[:block_start]]))
+                         + np.sum(~np.isnan(stat_cols["outcome"][block][block_flagged]), axis=1))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats_across_years["precision"].append(flagged_sums["outcome"] / flagged_known)
+            stats_across_years["recall"].append(flagged_sums["outcome"]
+                                                / np.nansum(stat_cols["outcome"][year_ix]))
+        stats_across_years["true_positives"].append(flagged_sums["true_positives"])
+
+    # Series.mean skips the years without a value, as in average_stat_across_periods
+    distribution = pd.DataFrame({
+        stat: pd.DataFrame(np.vstack(values)).mean(axis=0).values
+        for stat, values in stats_across_years.items()
+    })
+    distribution.index.name = "iteration"
+    return distribution
+
+
+def calc_serious_vs_frequent_across_years(preds_w_outcomes, serious_col, frequent_col, outcome,
+                                          evaluator=None):
+    '''
+    Compares two flagging policies for each period/year: flagging every
+    officer with a serious event (serious_col >= 1), and flagging the same
+    share of officers by their number of events (frequent_col), with ties
+    broken at random as in calc_precision_rbc.
+
+    Parameters:
+        preds_w_outcomes: (df) with the serious, frequent and outcome columns
+        serious_col: (str) name of column with the number of serious events
+        frequent_col: (str) name of column with the number of events
+        outcome: (str) name of outcome
+        evaluator: (Evaluator) optional, to reuse its cached ranks
+    Returns:
+        (df) with one row per year and the share of flagged officers
+        (flag_rate), the indicator precision of both policies and the
+        indicator base rate
+    '''
+    if evaluator is None:
+        evaluator = Evaluator(preds_w_outcomes)
+    pred_years = preds_w_outcomes["pred_year"].values
+    outcomes = preds_w_outcomes[outcome].clip(upper=1).values
+    serious_flagged = (preds_w_outcomes[serious_col] >= 1).values
+
+    flag_rate = pd.Series(serious_flagged).groupby(pred_years).mean()
+    # Flagging the top (1 - threshold)% by frequency flags as many officers as the serious policy
+    frequent_flag_weights = evaluator.get_flag_weights(frequent_col, 1.0 - flag_rate,
+                                                       ties="random")
+    frequent_sums = pd.DataFrame({
+        "flagged_outcome": frequent_flag_weights * (outcomes >= 1),
+        "flagged": frequent_flag_weights,
+    }).groupby(pred_years).sum()
+
+    serious_vs_frequent = pd.DataFrame({
+        "flag_rate": flag_rate,
+        "serious_precision": pd.Series(outcomes[serious_flagged]).groupby(
+            pred_years[serious_flagged]).mean(),
+        "frequent_precision": frequent_sums["flagged_outcome"] / frequent_sums["flagged"],
+        "base_rate": pd.Series(outcomes).groupby(pred_years).mean(),
+    }, index=flag_rate.index)
+    serious_vs_frequent.index.name = "pred_year"
+    return serious_vs_frequent.reset_index()
+
+
+def calc_serious_vs_frequent(preds_w_outcomes, comparisons, n_iterations=None, alpha=0.05,
+                             random_state=RBC_SAMPLE_RANDOM_STATE, evaluator=None):
+    '''
+    Compares flagging by serious events and by frequency (see
+    calc_serious_vs_frequent_across_years) for many (serious column, frequent
+    column, outcome) triples, averaged across years. The frequent precision
+    is the expected value under random tie-breaking. With n_iterations, the
+    ties are also broken n_iterations times with
+    calc_rbc_tie_break_distribution and the range of the frequent precision
+    over the tie-breaks is added.
+
+    Parameters:
+        preds_w_outcomes: (df) with the serious, frequent and outcome columns
+        comparisons: (list) of (serious_col, frequent_col, outcome) tuples
+        n_iterations: (int) optional number of random tie-breaks
+        alpha: (float) the range covers 1 - alpha of the tie-breaks
+        random_state: (int) random seed for the tie-breaks
+        evaluator: (Evaluator) optional, to reuse its cached ranks
+    Returns:
+        (df) with one row per comparison and the base rate, flag rate and
+        precision of both policies averaged across years, and with
+        n_iterations the frequent_precision_lower and frequent_precision_upper
+        quantiles of the tie-breaks
+    '''
+    if evaluator is None:
+        evaluator = Evaluator(preds_w_outcomes)
+    results = []
+    for serious_col, frequent_col, outcome in comparisons:
+        across_years = calc_serious_vs_frequent_across_years(
+            preds_w_outcomes, serious_col, frequent_col, outcome, evaluator=evaluator)
+        result = {"serious_col": serious_col, "frequent_col": frequent_col, "outcome": outcome}
+        for stat in ["base_rate", "flag_rate", "serious_precision", "frequent_precision"]:
+            result[stat] = average_stat_across_periods(across_years, stat)
+
+        if n_iterations is not None:
+            thresholds = 1.0 - across_years.set_index("pred_year")["flag_rate"]
+            distribution = calc_rbc_tie_break_distribution(
+                preds_w_outcomes, frequent_col, outcome, thresholds, n_iterations=n_iterations,
+                random_state=random_state, evaluator=evaluator)
+            result["frequent_precision_lower"] = distribution["precision"].quantile(alpha / 2)
+            result["frequent_precision_upper"] = distribution["precision"].quantile(1 - alpha / 2)
+        results.append(result)
+
+    return pd.DataFrame(results)
+
+
+def get_cluster_year_sums(cluster_codes, year_codes, n_clusters, n_years, values):
+    '''
+    Sums values by cluster and year
+
+    Parameters:
+        cluster_codes: (array) cluster of every row, in [0, n_clusters)
+        year_codes: (array) year of every row, in [0, n_years)
+        n_clusters: (int)
+        n_years: (int)
+        values: (array) to sum
+    Returns:
+        (array) of shape (n_clusters, n_years)
+    '''
+    return np.bincount(cluster_codes * n_years + year_codes, weights=values,
+                       minlength=n_clusters * n_years).reshape(n_clusters, n_years)
+
+
+def get_bootstrap_sums(cluster_sums, n_replicates, random_state):
+    '''
+    Resamples the clusters with replacement n_replicates times. Each
+    replicate is a vector of weights, the number of times every cluster is
+    drawn, so the sums of a replicate are a matrix product with the sums by
+    cluster.
+
+    Parameters:
+        cluster_sums: (array) of shape (n_clusters, n_sums)
+        n_replicates: (int)
+        random_state: (int) random seed for resampling
+    Returns:
+        (array) of shape (n_replicates, n_sums)
+    '''
+    rng = np.random.RandomState(random_state)
+    n_clusters = cluster_sums.shape[0]
+    draws = rng.randint(0, n_clusters, size=(n_replicates, n_clusters))
+    draws += np.arange(n_replicates)[:, None] * n_clusters
+    weights = np.bincount(draws.ravel(), minlength=n_replicates * n_clusters)
+    return weights.reshape(n_replicates, n_clusters).astype(np.float64) @ cluster_sums
+
+
+def calc_cluster_bootstrap_ci(preds_w_outcomes, methods, outcome, threshold, n_replicates=2000,
+                              alpha=0.05, indicator=True, cluster_col="tax_id",
+                              random_state=BOOTSTRAP_RANDOM_STATE, n_jobs=1, evaluator=None):
+    '''
+    Calculates bootstrap confidence intervals of the precision, recall and
+    number of true positives of several methods, and of the differences
+    between every pair of methods. The same officer appears in several years,
+    so officers (cluster_col) rather than observations are resampled, with
+    all of their years. Officers are flagged once on the full data, and the
+    intervals are percentile intervals of the statistics averaged across
+    years, as in calc_precision, calc_recall and calc_num_true_postives.
+    The replicates are drawn in chunks of BOOTSTRAP_CHUNK_SIZE, the chunk i
+    with the seed random_state + i, so the results do not depend on n_jobs.
+    The intervals are conditional on the flags: officers are not re-ranked
+    within a replicate, so the intervals leave out the variability of the
+    ranking and of the threshold cutoff. They are narrower than intervals
+    for the flagging rule as a whole would be.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores, outcomes and cluster_col
+        methods: (dict) from the name of each method to the name of its score
+                 column, or to a (score column, ties) tuple where ties is
+                 "average" like get_flags or "random" like get_flags_rbc
+        outcome: (str) name of outcome
+        threshold: (float) minimum percentile of risk score at which
+                    officers will be flagged. Range [0, 1]
+        n_replicates: (int) number of bootstrap replicates
+        alpha: (float) the intervals cover 1 - alpha
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        cluster_col: (str) name of the column with the clusters to resample
+        random_state: (int) random seed for resampling
+        n_jobs: (int) number of processes drawing the replicates
+        evaluator: (Evaluator) optional, to reuse its cached ranks
+    Returns:
+        (df) with one row per method (and per "method_a - method_b"
+        difference) and statistic, with the estimate on the full data, the
+        bootstrap standard error and the interval bounds, conditional on the
+        flags
+    '''
+    if evaluator is None:
+        evaluator = Evaluator(preds_w_outcomes)
+    methods = {name: (method, "average") if isinstance(method, str) else method
+               for name, method in methods.items()}
+    cluster_codes, clusters = pd.factorize(preds_w_outcomes[cluster_col])
+    year_codes, years = pd.factorize(preds_w_outcomes["pred_year"])
+    n_clusters, n_years = len(clusters), len(years)
+
+    outcomes = preds_w_outcomes[outcome].values.astype(np.float64)
+    outcome_values = ((outcomes >= 1) if indicator else outcomes).astype(np.float64)
+    sums = {"outcome": np.nan_to_num(outcome_values)}
+    for name, (pred_col, ties) in methods.items():
+        flag_weights = evaluator.get_flag_weights(pred_col, threshold, ties=ties)
+        sums[(name, "flagged_outcome")] = flag_weights * np.nan_to_num(outcome_values)
+        sums[(name, "flagged_known")] = flag_weights * ~np.isnan(outcome_values)
+        sums[(name, "true_positives")] = flag_weights * (outcomes >= 1)
+    sum_names = list(sums)
+    cluster_sums = np.hstack([
+        get_cluster_year_sums(cluster_codes, year_codes, n_clusters, n_years, sums[name])
+        for name in sum_names
+    ])
+
+    chunk_sizes = [min(BOOTSTRAP_CHUNK_SIZE, n_replicates - start)
+                   for start in range(0, n_replicates, BOOTSTRAP_CHUNK_SIZE)]
+    chunks = Parallel(n_jobs=n_jobs)(
+        delayed(get_bootstrap_sums)(cluster_sums, chunk_size, random_state + i)
+        for i, chunk_size in enumerate(chunk_sizes))
+    # The first row, with every officer drawn once, is the estimate on the full data
+    replicate_sums = np.vstack([cluster_sums.sum(axis=0, keepdims=True)] + chunks)
+    replicate_sums = {name: replicate_sums[:, i * n_years:(i + 1) * n_years]
+                      for i, name in enumerate(sum_names)}
+
+    stats = {}
+    for name in methods:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stats_across_years = {
+                "precision": (replicate_sums[(name, "flagged_outcome")]
+                              / replicate_sums[(name, "flagged_known")]),
+                "recall": replicate_sums[(name, "flagged_outcome")] / replicate_sums["outcome"],
+                "true_positives": replicate_sums[(name, "true_positives")],
+            }
+        for stat, values in stats_across_years.items():
+            # Series.mean skips the years without a value, as in average_stat_across_periods
+            stats[(name, stat)] = pd.DataFrame(values).mean(axis=1).values
+    for name_a, name_b in combinations(methods, 2):
+        for stat in ["precision", "recall", "true_positives"]:
+            stats[(f"{name_a} - {name_b}", stat)] = stats[(name_a, stat)] - stats[(name_b, stat)]
+
+    cis = []
+    for (name, stat), values in stats.items():
+        cis.append({
+            "method": name,
+            "stat": stat,
+            "estimate": values[0],
+            "std_error": np.nanstd(values[1:], ddof=1),
+            "ci_lower": np.nanquantile(values[1:], alpha / 2),
+            "ci_upper": np.nanquantile(values[1:], 1 - alpha / 2),
+        })
+    return pd.DataFrame(cis)
+
+
+def add_roster_columns(preds_w_outcomes, roster_cols, roster_path=ROSTER_PATH):
+    '''
+    Adds officer attributes from the roster, e.g. "Officer Race" or
+    "Current Rank", to use as subgroups in calc_subgroup_breakdown
+
+    Parameters:
+        preds_w_outcomes: (df) with a tax_id column
+        roster_cols: (list) of names of columns of clean_roster.parquet
+        roster_path: (str) path to clean_roster.parquet
+    Returns:
+        (df) same as preds_w_outcomes, with the same rows in the same order,
+        and the roster columns. Officers missing from the roster get NaN
+    '''
+    roster = pd.read_parquet(roster_path, columns=["tax_id"] + list(roster_cols))
+    return preds_w_outcomes.merge(roster, on="tax_id", how="left", validate="many_to_one")
+
+
+def get_dominant_fado_type(preds_w_outcomes, window="past_five_years"):
+    '''
+    Gets the most frequent FADO type of the allegations against each officer
+    in a window, to use as a subgroup of complaint mix
+
+    Parameters:
+        preds_w_outcomes: (df) with the {window}.all_allegations.FADO_* features
+        window: (str) past_year, past_two_years or past_five_years
+    Returns:
+        (series) with the FADO type with most allegations (the first one in
+        FADO_TYPES order for ties), or "none" for officers without allegations
+    '''
+    fado_counts = preds_w_outcomes[[f"{window}.all_allegations.{t}" for t in FADO_TYPES]].values
+    dominant_fado_type = pd.Series(np.array(FADO_TYPES, dtype=object)[fado_counts.argmax(axis=1)],
+                                   index=preds_w_outcomes.index)
+    dominant_fado_type[fado_counts.sum(axis=1) == 0] = "none"
+    return dominant_fado_type
+
+
+def calc_subgroup_breakdown_across_years(preds_w_outcomes, pred_col, outcome, thresholds,
+                                         group_cols, indicator=True, ties="average",
+                                         evaluator=None):
+    '''
+    Calculates the flag rate, precision, recall and number of true positives
+    within subgroups of officers, for each period/year and threshold.
+    Officers are flagged as in get_flags (or get_flags_rbc with
+    ties="random"), ranked against all the officers of the year rather than
+    within their group. For each threshold, the sums of every group and year
+    are then a single bincount over the frame.
+
+    Parameters:
+        preds_w_outcomes: (df) with risk scores, outcomes and group_cols (see
+                          add_roster_columns and get_dominant_fado_type)
+        pred_col: (str) name of column with risk scores produced by model
+                  of interest
+        outcome: (str) name of outcome
+        thresholds: (list) of minimum percentiles of risk score at which
+                    officers will be flagged. Range [0, 1]
+        group_cols: (list) of names of columns defining the subgroups.
+                    Officers with a missing value are left out, as in groupby
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        ties: (str) "average" like get_flags, or "random" for the expected
+              statistics under random tie-breaking like get_flags_rbc
+        evaluator: (Evaluator) optional, built on the same rows, to reuse its
+                   cached ranks
+    Returns:
+        (df) with one row per group, year and threshold, with the number of
+        officers, the number of flagged officers, the flag rate, precision,
+        recall, true positives and base rate of the group
+    '''
+    if evaluator is None:
+        evaluator = Evaluator(preds_w_outcomes)
+    group_cols = list(group_cols)
+    groups = preds_w_outcomes.groupby(group_cols)
+    group_codes = np.asarray(groups.ngroup(), dtype=np.float64)
+    in_group = group_codes >= 0
+    group_index = groups.size().index.to_frame(index=False)
+
+    year_codes, pred_years = pd.factorize(preds_w_outcomes["pred_year"])
+    n_years = len(pred_years)
+    cell_codes = group_codes[in_group].astype(np.int64) * n_years + year_codes[in_group]
+    n_cells = len(group_index) * n_years
+
+    def cell_sums(values):
+        return np.bincount(cell_codes, weights=values[in_group], minlength=n_cells)
+
+    outcomes = preds_w_outcomes[outcome].values.astype(np.float64)
+    outcome_values = ((outcomes >= 1) if indicator else outcomes).astype(np.float64)
+    known = (~np.isnan(outcome_values)).astype(np.float64)
+    outcome_values = np.nan_to_num(outcome_values)
+    true_positives = (outcomes >= 1).astype(np.float64)
+
+    n_officers = cell_sums(np.ones(len(preds_w_outcomes)))
+    total_outcome = cell_sums(outcome_values)
+    n_known = cell_sums(known)
+
+    breakdowns = []
+    for threshold in thresholds:
+        flag_weights = evaluator.get_flag_weights(pred_col, threshold, ties=ties)
+        n_flagged = cell_sums(flag_weights)
+        flagged_outcome = cell_sums(flag_weights * outcome_values)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            breakdown = {
+                "threshold": threshold,
+                "n_officers": n_officers,
+                "n_flagged": n_flagged,
+                "flag_rate": n_flagged / n_officers,
+                "precision": flagged_outcome / cell_sums(flag_weights * known),
+                "recall": flagged_outcome / total_outcome,
+                "true_positives": cell_sums(flag_weights * true_positives),
+                "base_rate": total_outcome / n_known,
+            }
+        breakdowns.append(pd.DataFrame(breakdown))
+
+    breakdown = pd.concat(breakdowns, ignore_index=True)
+    cells = np.tile(np.arange(n_cells), len(thresholds))
+    breakdown.insert(0, "pred_year", np.asarray(pred_years)[cells % n_years])
+    for i, group_col in enumerate(group_cols):
+        breakdown.insert(i, group_col, group_index[group_col].values[cells // n_years])
+    # Groups without officers in a year have no statistics that year
+    return breakdown[breakdown["n_officers"] > 0].reset_index(drop=True)
+
+
+def calc_subgroup_breakdown(preds_w_outcomes, pred_col, outcome, thresholds, group_cols,
+                            indicator=True, ties="average", evaluator=None):
+    '''
+    Calculates the flag rate, precision, recall and number of true positives
+    within subgroups of officers at every threshold, averaged across years.
+    See calc_subgroup_breakdown_across_years for the parameters.
+
+    Returns:
+        (df) with one row per group and threshold
+    '''
+    breakdown_across_years = calc_subgroup_breakdown_across_years(
+        preds_w_outcomes, pred_col, outcome, thresholds, group_cols, indicator=indicator,
+        ties=ties, evaluator=evaluator)
+    # Series.mean per group and threshold, as in average_stat_across_periods
+    return breakdown_across_years.drop(columns="pred_year").groupby(
+        list(group_cols) + ["threshold"], sort=False).mean().reset_index()
+
+
+class QuantileSketch:
+    '''
+    Mergeable sketch of the distribution of a stream of scores, with a
+    bounded size and a known error on the rank of any score.
+    Scores are kept in levels, where a score of level h stands for 2**h
+    scores. When a level holds size scores or more, it is sorted and every
+    other score (alternating between the odd and even ones) is moved to the
+    next level with twice the weight. A compaction of level h moves the rank
+    of any score by at most 2**h, and max_rank_error adds these up. The rank
+    estimated from the sketch is therefore within max_rank_error of the exact
+    rank, for any score, and max_rank_error / n is at most about
+    log2(n / size) / size.
+
+    Parameters:
+        size: (int) number of scores kept per level
+    '''
+
+    def __init__(self, size=QUANTILE_SKETCH_SIZE):
+        self.size = size
+        self.levels = [np.empty(0)]
+        self.n = 0
+        self.max_rank_error = 0
+        self._n_compactions = 0
+
+    def update(self, scores):
+        '''
+        Adds scores to the sketch. NaN are ignored
+
+        Parameters:
+            scores: (array)
+        '''
+        scores = np.asarray(scores, dtype=np.float64)
+        scores = scores[~np.isnan(scores)]
+        self.n += len(scores)
+        self.levels[0] = np.concatenate([self.levels[0], scores])
+        self._compact()
+
+    def merge(self, other):
+        '''
+        Adds the scores of another sketch, e.g. of another chunk of the data
+
+        Parameters:
+            other: (QuantileSketch)
+        '''
+        self.n += other.n
+        self.max_rank_error += other.max_rank_error
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self._compact()
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) >= self.size:
+                level = np.sort(self.levels[h])
+                # An odd score out stays at its level
+                n_kept = len(level) % 2
+                offset = self._n_compactions % 2
+                self._n_compactions += 1
+                promoted = level[n_kept + offset::2]
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                self.levels[h] = level[:n_kept]
+                self.max_rank_error += 2 ** h
+            h += 1
+
+    def get_weighted_scores(self):
+        '''
+        Returns:
+            scores: (array) distinct scores of the sketch, in ascending order
+            weights: (array) number of scores each of them stands for. The
+                     weights add up to n
+        '''
+        scores = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** h)
+                                  for h, level in enumerate(self.levels)])
+        scores, inverse = np.unique(scores, return_inverse=True)
+        return scores, np.bincount(inverse, weights=weights, minlength=len(scores))
+
+    def get_rank_brackets(self, ranks):
+        '''
+        Finds scores on either side of the scores at the given ranks, with a
+        margin of max_rank_error + 1 so that they hold for the exact ranks
+
+        Parameters:
+            ranks: (array) numbers of scores, in ascending order of score
+        Returns:
+            lows: (array) scores with fewer than rank - 1 scores lower or
+                  equal to them (-inf if there is none in the sketch)
+            highs: (array) scores with more than rank + 1 scores lower than
+                   them (inf if there is none in the sketch)
+        '''
+        scores, weights = self.get_weighted_scores()
+        n_below_or_tied = np.cumsum(weights)
+        n_below = n_below_or_tied - weights
+        margin = self.max_rank_error + 1
+        low_ix = np.searchsorted(n_below_or_tied + margin, ranks, side="left") - 1
+        high_ix = np.searchsorted(n_below - margin, ranks, side="right")
+        lows = np.append(scores, -np.inf)[low_ix]
+        highs = np.append(scores, np.inf)[high_ix]
+        return lows, highs
+
+    def get_rank_scores(self, ranks):
+        '''
+        Estimates the scores at the given ranks. The exact rank of each of
+        them is within max_rank_error + 1 of the given rank
+
+        Parameters:
+            ranks: (array) numbers of scores, in ascending order of score
+        Returns:
+            (array) of scores (NaN if the sketch is empty)
+        '''
+        scores, weights = self.get_weighted_scores()
+        if len(scores) == 0:
+            return np.full(len(ranks), np.nan)
+        ix = np.searchsorted(np.cumsum(weights), ranks, side="left")
+        return scores[np.minimum(ix, len(scores) - 1)]
+
+
+def read_prediction_batches(predictions_path, columns, batch_size=STREAMING_BATCH_SIZE):
+    '''
+    Reads the predictions parquet (a file or a year-partitioned dataset)
+    batch_size rows at a time
+
+    Parameters:
+        predictions_path: (str) path to observations_with_predictions.parquet
+        columns: (list) of names of columns to read, besides observation_date
+        batch_size: (int) number of rows read at a time
+    Returns:
+        (generator) of dfs with the columns and pred_year
+    '''
+    dataset = ds.dataset(predictions_path, format="parquet", partitioning="hive")
+    columns = list(dict.fromkeys(["observation_date"] + list(columns)))
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        preds = batch.to_pandas()
+        preds["pred_year"] = preds["observation_date"].dt.year
+        yield preds
+
+
+def get_streaming_ranks(n, thresholds, ties):
+    '''
+    Gets the rank around which the flagged officers start, for
+    QuantileSketch.get_rank_brackets
+
+    Parameters:
+        n: (int) number of officers with a score
+        thresholds: (array) minimum percentiles of risk score at which
+                    officers will be flagged. Range [0, 1]
+        ties: (str) "average" or "random"
+    Returns:
+        (array) of ranks
+    '''
+    if ties == "average":
+        return thresholds * n
+    # The flagged officers start at position n - n_flagged of the ascending scores
+    n_flagged = n - np.searchsorted(np.arange(1, n + 1) / max(n, 1), thresholds, side="left")
+    return n - n_flagged + 0.5
+
+
+def get_streaming_cutoff_brackets(sketch, ranks):
+    '''
+    Gets brackets, like QuantileSketch.get_rank_brackets, that only hold the
+    score estimated by the sketch at each rank
+
+    Parameters:
+        sketch: (QuantileSketch)
+        ranks: (array) numbers of scores, in ascending order of score
+    Returns:
+        lows: (array) largest floats below the estimated scores
+        highs: (array) smallest floats above the estimated scores
+    '''
+    cutoffs = sketch.get_rank_scores(ranks)
+    return np.nextafter(cutoffs, -np.inf), np.nextafter(cutoffs, np.inf)
+
+
+def compact_streaming_band(accumulator):
+    '''
+    Adds the pending rows of an accumulator of
+    calc_streaming_threshold_sweep_across_years to its band, summed by
+    distinct score
+
+    Parameters:
+        accumulator: (dict) of one year
+    '''
+    if not accumulator["pending"]:
+        return
+    pending_scores, pending_sums = zip(*accumulator["pending"])
+    band_scores, inverse = np.unique(
+        np.concatenate([accumulator["band_scores"]] + list(pending_scores)), return_inverse=True)
+    band_sums = np.vstack([accumulator["band_sums"]] + list(pending_sums))
+    accumulator["band_scores"] = band_scores
+    accumulator["band_sums"] = np.column_stack([
+        np.bincount(inverse, weights=band_sums[:, j], minlength=len(band_scores))
+        for j in range(band_sums.shape[1])
+    ])
+    accumulator["pending"] = []
+    accumulator["n_pending"] = 0
+
+
+def collapse_streaming_band(accumulator, brackets, new_brackets):
+    '''
+    Moves the band of an accumulator of
+    calc_streaming_threshold_sweep_across_years from brackets to narrower
+    new_brackets: the scores it holds that are now at or above hi are added
+    to the flagged sums, those at or below lo are counted as below, and only
+    the scores within the new brackets are kept
+
+    Parameters:
+        accumulator: (dict) of one year, with no pending rows
+        brackets: (tuple) of the lows and highs the band was kept for
+        new_brackets: (tuple) of lows and highs within brackets
+    '''
+    band_scores = accumulator["band_scores"]
+    band_sums = accumulator["band_sums"]
+    for i, (low, high, new_low, new_high) in enumerate(zip(*brackets, *new_brackets)):
+        in_band = (band_scores > low) & (band_scores < high)
+        accumulator["above"][i] += band_sums[in_band & (band_scores >= new_high)].sum(axis=0)
+        accumulator["n_below"][i] += band_sums[in_band & (band_scores <= new_low), 0].sum()
+    new_lows, new_highs = new_brackets
+    kept = ((band_scores[None, :] > new_lows[:, None])
+            & (band_scores[None, :] < new_highs[:, None])).any(axis=0)
+    accumulator["band_scores"] = band_scores[kept]
+    accumulator["band_sums"] = band_sums[kept]
+
+
+def calc_streaming_threshold_sweep_across_years(predictions_path, pred_col, outcome, thresholds,
+                                                indicator=True, ties="average", exact=True,
+                                                sketch_size=QUANTILE_SKETCH_SIZE,
+                                                batch_size=STREAMING_BATCH_SIZE,
+                                                max_band_size=STREAMING_BAND_SIZE):
+    '''
+    Calculates the same statistics as calc_threshold_sweep_across_years for
+    predictions that do not fit in memory, in two passes over the parquet.
+    The first pass builds a QuantileSketch of the scores of each year. Its
+    rank error bound gives, for each threshold, scores lo and hi such that
+    the officers scored at or below lo are certainly not flagged and those at
+    or above hi certainly are. The second pass adds up the outcomes of the
+    officers above hi, counts those below lo, and keeps the sums of the
+    distinct scores in between (the band), from which the exact cutoff is
+    found at the end. The results are then the same as with exact ranking
+    (up to float summation order).
+    The band holds up to about 4 * max_rank_error scores per threshold, so
+    its memory is not bounded but grows as O(n * log(n / sketch_size) /
+    sketch_size) per year, e.g. a few percent of the scores with the default
+    sketch_size. A year whose band has more than max_band_size distinct
+    scores falls back, with a warning, to the approximate results below.
+    With exact=False, lo and hi are taken just around the score estimated
+    by the sketch at the cutoff rank, so that only the officers tied at it
+    are kept (at most one score per threshold). The officers flagged then
+    differ from the exact ones only between the estimated and the exact
+    cutoff, i.e. n_flagged is within max_rank_error + 1 officers of the
+    exact one, a share of at most about log2(n / sketch_size) / sketch_size
+    of the officers of the year.
+
+    Parameters:
+        predictions_path: (str) path to observations_with_predictions.parquet
+        pred_col: (str) name of column with risk scores produced by model
+                  of interest
+        outcome: (str) name of outcome
+        thresholds: (list) of minimum percentiles of risk score at which
+                    officers will be flagged. Range [0, 1]
+        indicator: (bool) True if we want to calculate the indicator precision
+                   and recall
+        ties: (str) "average" like get_flags, or "random" for the expected
+              statistics under random tie-breaking like get_flags_rbc
+        exact: (bool) False to flag against the cutoff estimated by the
+               sketch instead of keeping the band
+        sketch_size: (int) size of the sketches, see QuantileSketch
+        batch_size: (int) number of rows read at a time
+        max_band_size: (int) number of distinct scores of the band of a
+                       year above which it falls back to exact=False
+    Returns:
+        (df) with one row per year and threshold, with the number of flagged
+        officers, precision, recall and true positives
+    '''
+    if ties not in ["average", "random"]:
+        raise ValueError(f"ties must be 'average' or 'random', got {ties!r}")
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    sketches = {}
+    for preds in read_prediction_batches(predictions_path, [pred_col], batch_size=batch_size):
+        for pred_year, year_ix in preds.groupby("pred_year").indices.items():
+            sketches.setdefault(pred_year, QuantileSketch(sketch_size)).update(
+                preds[pred_col].values[year_ix])
+    get_brackets = QuantileSketch.get_rank_brackets if exact else get_streaming_cutoff_brackets
+    brackets = {
+        pred_year: get_brackets(sketch, get_streaming_ranks(sketch.n, thresholds, ties))
+        for pred_year, sketch in sketches.items()
+    }
+
+    sum_cols = ["count", "outcome", "known", "true_positives"]
+    accumulators = {}
+    for preds in read_prediction_batches(predictions_path, [pred_col, outcome],
+                                         batch_size=batch_size):
+        outcomes = preds[outcome].values.astype(np.float64)
+        outcome_values = ((outcomes >= 1) if indicator else outcomes).astype(np.float64)
+        for pred_year, year_ix in preds.groupby("pred_year").indices.items():
+            accumulator = accumulators.setdefault(pred_year, {
+                "total_outcome": 0,
+                "above": np.zeros((len(thresholds), len(sum_cols))),
+                "n_below": np.zeros(len(thresholds)),
+                "band_scores": np.empty(0),
+                "band_sums": np.empty((0, len(sum_cols))),
+                "pending": [],
+                "n_pending": 0,
+            })
+            year_values = np.column_stack([
+                np.ones(len(year_ix)),
+                np.nan_to_num(outcome_values[year_ix]),
+                ~np.isnan(outcome_values[year_ix]),
+                outcomes[year_ix] >= 1,
+            ])
+            accumulator["total_outcome"] += year_values[:, 1].sum()
+
+            # NaN scores are never flagged, and fall in none of the masks
+            scores = preds[pred_col].values[year_ix].astype(np.float64)
+            lows, highs = brackets[pred_year]
+            accumulator["above"] += (scores[None, :] >= highs[:, None]) @ year_values
+            accumulator["n_below"] += (scores[None, :] <= lows[:, None]).sum(axis=1)
+            # The scores between lo and hi of any threshold are kept for the band
+            between = ((scores[None, :] > lows[:, None])
+                       & (scores[None, :] < highs[:, None])).any(axis=0)
+            if not between.any():
+                continue
+            accumulator["pending"].append((scores[between], year_values[between]))
+            accumulator["n_pending"] += between.sum()
+            # Sorting into the band only once the pending rows outnumber it keeps the total
+            # sorting work within a constant factor of sorting the band once
+            if accumulator["n_pending"] < max(len(accumulator["band_scores"]), batch_size):
+                continue
+            compact_streaming_band(accumulator)
+            if len(accumulator["band_scores"]) > max_band_size:
+                sketch = sketches[pred_year]
+                warnings.warn(
+                    f"the band of {pred_year} has more than {max_band_size} scores, its "
+                    f"n_flagged is only within {sketch.max_rank_error + 1} of the exact one")
+                new_brackets = get_streaming_cutoff_brackets(
+                    sketch, get_streaming_ranks(sketch.n, thresholds, ties))
+                collapse_streaming_band(accumulator, brackets[pred_year], new_brackets)
+                brackets[pred_year] = new_brackets
+
+    sweeps = []
+    for pred_year in sorted(accumulators):
+        accumulator = accumulators[pred_year]
+        compact_streaming_band(accumulator)
+        n = sketches[pred_year].n
+        ranks = get_streaming_ranks(n, thresholds, ties)
+        flagged_sums = accumulator["above"].copy()
+        lows, highs = brackets[pred_year]
+        band_scores = accumulator["band_scores"]
+        for i, threshold in enumerate(thresholds):
+            between_sums = accumulator["band_sums"][(band_scores > lows[i])
+                                                    & (band_scores < highs[i])]
+            counts = between_sums[:, 0]
+            n_below = accumulator["n_below"][i] + np.cumsum(counts) - counts
+            n_below_or_tied = n_below + counts
+            if ties == "average":
+                # Same percentile ranks as get_percentile_ranks_sorted
+                flag_weights = (((n_below + 1 + n_below_or_tied) / 2) / n >= threshold) * 1.0
+            else:
+                flagged_position = ranks[i] - 0.5
+                flag_weights = np.clip((n_below_or_tied - flagged_position) / counts, 0, 1)
+            flagged_sums[i] += flag_weights @ between_sums
+
+        n_flagged, flagged_outcome, flagged_known, true_positives = flagged_sums.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sweeps.append(pd.DataFrame({
+                "pred_year": pred_year,
+                "threshold": thresholds,
+                "n_flagged": n_flagged,
+                "precision": flagged_outcome / flagged_known,
+                "recall": flagged_outcome / accumulator["total_outcome"],
+                "true_positives": true_positives,
+            }))
+    return pd.concat(sweeps, ignore_index=True)
+
+
+def calc_streaming_threshold_sweep(predictions_path, pred_col, outcome, thresholds,
+                                   indicator=True, ties="average", exact=True,
+                                   sketch_size=QUANTILE_SKETCH_SIZE,
+                                   batch_size=STREAMING_BATCH_SIZE,
+                                   max_band_size=STREAMING_BAND_SIZE):
+    '''
+    Calculates the precision, recall and number of true positives at every
+    threshold, averaged across years, like calc_threshold_sweep, for
+    predictions that do not fit in memory. See
+    calc_streaming_threshold_sweep_across_years for the parameters.
+
+    Returns:
+        (df) with one row per threshold and the precision, recall and
+        true_positives columns
+    '''
+    sweep_across_years = calc_streaming_threshold_sweep_across_years(
+        predictions_path, pred_col, outcome, thresholds, indicator=indicator, ties=ties,
+        exact=exact, sketch_size=sketch_size, batch_size=batch_size, max_band_size=max_band_size)
+    stat_cols = ["precision", "recall", "true_positives"]
+    # Series.mean per threshold, as in average_stat_across_periods
+    sweep = sweep_across_years.groupby("threshold", sort=False)[stat_cols].agg(
+        lambda stat: average_stat_across_periods(stat.to_frame(), stat.name))
+    return sweep.reset_index()
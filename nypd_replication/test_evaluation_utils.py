@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from evaluation_utils import (
+    calc_num_true_positives_across_years,
+    calc_recall_across_years,
+    get_flagged_sums_across_years,
+    get_flags,
+)
+
+
+def make_preds(random_state=0):
+
+    rng = np.random.RandomState(random_state)
+    n = 600
+    preds = pd.DataFrame({
+        "pred_year": np.repeat([2016, 2017, 2018], n // 3),
+        # Rounded scores, so there are ties at the cutoffs
+        "phat": np.round(rng.uniform(size=n), 2),
+        "outcome": rng.poisson(0.3, size=n).astype(np.float64),
+    })
+    preds.loc[rng.choice(n, 30, replace=False), "outcome"] = np.nan
+    return preds
+
+
+def test_flagged_sums_keep_the_dtype_of_the_column():
+
+    preds_w_flags = get_flags(make_preds(), "phat", 0.9)
+    preds_w_flags["indicator_outcome"] = preds_w_flags["outcome"] >= 1
+
+    true_positives = get_flagged_sums_across_years(preds_w_flags, "indicator_outcome")
+    assert true_positives.dtype == np.int64
+
+    outcome_sums = get_flagged_sums_across_years(preds_w_flags, "outcome")
+    assert outcome_sums.dtype == np.float64
+
+
+def test_flagged_sums_are_zero_for_years_without_flags():
+
+    preds_w_flags = get_flags(make_preds(), "phat", 0.9)
+    preds_w_flags["indicator_outcome"] = preds_w_flags["outcome"] >= 1
+    preds_w_flags.loc[preds_w_flags["pred_year"] == 2017, "flagged"] = False
+
+    true_positives = get_flagged_sums_across_years(preds_w_flags, "indicator_outcome")
+    assert true_positives.index.tolist() == [2016, 2017, 2018]
+    assert true_positives.loc[2017] == 0
+    assert true_positives.dtype == np.int64
+
+
+def test_across_years_stats_match_the_per_year_loop():
+
+    preds = make_preds()
+    preds_w_flags = get_flags(preds, "phat", 0.9)
+    expected_true_positives = preds_w_flags.groupby("pred_year").apply(
+        lambda x: (x.loc[x["flagged"], "outcome"] >= 1).sum())
+    expected_recall = preds_w_flags.groupby("pred_year").apply(
+        lambda x: (x.loc[x["flagged"], "outcome"] >= 1).sum() / (x["outcome"] >= 1).sum())
+
+    true_positives = calc_num_true_positives_across_years(preds, "phat", "outcome", 0.9)
+    pd.testing.assert_series_equal(true_positives["true_positives"], expected_true_positives,
+                                   check_names=False)
+
+    recall = calc_recall_across_years(preds, "phat", "outcome", 0.9)
+    pd.testing.assert_series_equal(recall["recall"], expected_recall, check_names=False)